@@ -0,0 +1,100 @@
+"""
+Throughput of the c.py codec without a q process: encode, decode, compress, decompress and the round trip through
+a mock.Server, for every atom and vector type, tables, keyed tables and nested lists, at several sizes.
+
+    python bench.py [-numpy] [size ...]
+
+prints, for each, the MB/s of message bytes and the rows/s, rows being the items of a vector, the rows of a table
+or the items of a nested list.  -numpy decodes vectors as numpy arrays and datetime64.  The sizes default to
+1000 and 100000.
+"""
+
+import sys
+import time
+import datetime
+import array
+from uuid import UUID
+import c
+import mock
+
+def atoms():
+    """an atom of every type"""
+    cases = [('boolean', True), ('guid', UUID(int=12345)), ('long', 2**40), ('float', 1.5),
+             ('symbol', 'IBM'), ('timestamp', c.timestamp(2020, 1, 2, 3, 4, 5)), ('month', c.Month(240)),
+             ('date', datetime.date(2020, 1, 2)), ('datetime', datetime.datetime(2020, 1, 2, 3, 4, 5)),
+             ('timespan', datetime.timedelta(seconds=5)), ('minute', c.Minute(90)), ('second', c.Second(5400)),
+             ('time', datetime.time(1, 2, 3))]
+    if c.numpy is not None:
+        # the atom types no Python type is encoded as
+        cases += [('byte', c.numpy.int8(5)), ('short', c.numpy.int16(300)), ('int', c.numpy.int32(5)),
+                  ('real', c.numpy.float32(1.5)), ('char', c.numpy.bytes_(b'x'))]
+    return cases
+
+def vectors(n):
+    """a vector of n items of every type, then tables of n rows and a nested list of n items"""
+    stamp = c.timestamp(2020, 1, 2)
+    day = datetime.date(2020, 1, 2)
+    moment = datetime.datetime(2020, 1, 2)
+    cases = [('boolean', [i % 2 == 0 for i in range(n)]), ('guid', [UUID(int=i) for i in range(n)]),
+             ('byte', array.array('b', [i % 100 for i in range(n)])), ('short', array.array('h', [i % 30000 for i in range(n)])),
+             ('int', array.array('i', range(n))), ('long', [2**40 + i for i in range(n)]),
+             ('real', array.array('f', [i / 2 for i in range(n)])), ('float', array.array('d', [i / 2 for i in range(n)])),
+             ('char', b'x' * n), ('symbol', ['S%d' % (i % 1000) for i in range(n)]),
+             ('timestamp', [stamp + datetime.timedelta(seconds=i) for i in range(n)]),
+             ('month', [c.Month(i % 1000) for i in range(n)]), ('date', [day + datetime.timedelta(days=i % 10000) for i in range(n)]),
+             ('datetime', [moment + datetime.timedelta(seconds=i) for i in range(n)]),
+             ('timespan', [datetime.timedelta(microseconds=i) for i in range(n)]), ('minute', [c.Minute(i % 1440) for i in range(n)]),
+             ('second', [c.Second(i % 86400) for i in range(n)]), ('time', [datetime.time(i % 24, i % 60) for i in range(n)])]
+    syms = ['S%d' % (i % 1000) for i in range(n)]
+    values = [array.array('d', [i / 4 for i in range(n)]), [i for i in range(n)], [stamp + datetime.timedelta(seconds=i) for i in range(n)]]
+    table = c.Flip(c.Dict(['sym', 'price', 'size', 'time'], [syms] + values))
+    keyed = c.Dict(c.Flip(c.Dict(['sym'], [syms])), c.Flip(c.Dict(['price', 'size', 'time'], values)))
+    nested = [[i, 'x', [1.0, 2.0], b'ab'] for i in range(n)]
+    return [('vector ' + name, x) for name, x in cases] + [('table', table), ('keyed table', keyed), ('nested list', nested)]
+
+def seconds(f, budget=0.25):
+    """seconds taken by one call of f, averaged over calls for about budget seconds"""
+    f()
+    calls = 0
+    start = time.perf_counter()
+    while True:
+        f()
+        calls += 1
+        elapsed = time.perf_counter() - start
+        if elapsed > budget:
+            return elapsed / calls
+
+def run(sizes, numpy=False, out=sys.stdout):
+    server = mock.Server(little_endian=False)
+    conn = c.q('127.0.0.1', server.port, 'bench')
+    codec = c.q('localhost', 0, '', 0)  # no attempts: never connected, just the codec
+    codec.remote_ver = 3
+    for q in (conn, codec):
+        if numpy:
+            q.numpy = True
+            q.temporal = 'numpy'
+    out.write('%-22s %8s %-10s %10s %14s\n' % ('case', 'rows', 'op', 'MB/s', 'rows/s'))
+    cases = [('atom ' + name, x, 1) for name, x in atoms()]
+    for n in sizes:
+        cases += [(name, x, n) for name, x in vectors(n)]
+    for name, x, n in cases:
+        message = bytes(codec._encode(True, x))
+        compressed = codec._z(bytearray(message))
+        ops = [('encode', lambda: codec._encode(True, x)),
+               ('decode', lambda: codec._decode(False, False, message)),
+               ('compress', lambda: codec._z(bytearray(message)))]
+        if compressed[2] == 1:
+            ops.append(('decompress', lambda: codec._u(False, compressed)))
+        ops.append(('round trip', lambda: conn.k('echo', [x])))
+        for op, f in ops:
+            t = seconds(f)
+            out.write('%-22s %8d %-10s %10.1f %14.0f\n' % (name, n, op, len(message) / t / 1e6, n / t))
+        out.flush()
+    conn.close()
+    server.close()
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    numpy = '-numpy' in args
+    sizes = [int(a) for a in args if a != '-numpy'] or [1000, 100000]
+    run(sizes, numpy)
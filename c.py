@@ -30,15 +30,96 @@
 
 import sys
 import socket
+import select
+import threading
+import asyncio
+import collections
 import array
 import struct
 import time
+import copy
 import datetime
 import logging
+import concurrent.futures
+import os
+from multiprocessing import shared_memory
 from uuid import UUID
+try:
+    import numpy
+except ImportError:
+    numpy = None
 SYNC=True
 ASYNC=False
 nt = [ 0, 1, 16, 0, 1, 2, 4, 8, 4, 8, 1, 0, 8, 4, 4, 8, 8, 4, 4, 4 ]  #byte length of different datatypes
+#array.array typecodes used to decode the fixed width vector types in one step
+at = { 1: 'b', 4: 'b', 5: 'h', 6: 'i', 7: 'q', 8: 'f', 9: 'd', 12: 'q', 13: 'i', 14: 'i', 15: 'd', 16: 'q', 17: 'i', 18: 'i', 19: 'i' }
+#numpy dtypes for the numeric vector types when q.numpy is set
+npt = { 1: 'bool', 4: 'int8', 5: 'int16', 6: 'int32', 7: 'int64', 8: 'float32', 9: 'float64' }
+#struct formats used to encode lists of numeric atoms in one pack
+pt = { 1: '?', 4: 'b', 5: 'h', 6: 'i', 7: 'q', 8: 'f', 9: 'd' }
+#q vector types of array.array typecodes, keyed by typecode and itemsize
+aqt = { ('b',1): 4, ('B',1): 4, ('h',2): 5, ('i',4): 6, ('l',4): 6, ('l',8): 7, ('q',8): 7, ('f',4): 8, ('d',8): 9 }
+#q vector types of numpy dtypes, keyed by dtype kind and itemsize
+nqt = { ('b',1): 1, ('i',1): 4, ('u',1): 4, ('i',2): 5, ('u',2): 6, ('i',4): 6, ('u',4): 7, ('i',8): 7,
+        ('f',4): 8, ('f',8): 9, ('S',1): 10 }
+#q vector types of numpy datetime64/timedelta64 units, the default being timestamp and timespan
+nqu = { ('M','M'): 13, ('M','D'): 14, ('m','m'): 17, ('m','s'): 18, ('m','ms'): 19 }
+#numpy units of the q temporal vector types when q.temporal is 'numpy', and offsets of the kdb epoch from the UNIX one in those units
+tnu = { 12: 'datetime64[ns]', 13: 'datetime64[M]', 14: 'datetime64[D]', 15: 'datetime64[ms]',
+        16: 'timedelta64[ns]', 17: 'timedelta64[m]', 18: 'timedelta64[s]', 19: 'timedelta64[ms]' }
+tne = { 12: 946684800000000000, 13: 360, 14: 10957, 15: 946684800000 }
+LITTLE_ENDIAN = sys.byteorder == 'little'
+#prebuilt structs of the fixed width atoms, indexed by the little_endian flag of a message; messages are written big endian, with [0]
+sb = struct.Struct('b')
+sh = (struct.Struct('>h'), struct.Struct('<h'))
+si = (struct.Struct('>i'), struct.Struct('<i'))
+sj = (struct.Struct('>q'), struct.Struct('<q'))
+se = (struct.Struct('>f'), struct.Struct('<f'))
+sf = (struct.Struct('>d'), struct.Struct('<d'))
+#conversions of extra Python types to values the encoder knows, see register_encoder
+encoders = {}
+_encoders = {}  # encoder found for each Python type met, None for types without one
+#conversions of decoded q values, keyed by q type, see register_decoder
+decoders = {}
+
+def register_encoder(pytype, f):
+    """encode instances of pytype, subclasses included, as f(x).  For example register_encoder(decimal.Decimal, float)
+    sends decimals as floats and register_encoder(enum.Enum, lambda e: e.name) sends enum members as symbols"""
+    encoders[pytype] = f
+    _encoders.clear()
+
+def register_decoder(qtype, f):
+    """replace every decoded value of q type qtype (negative for atoms) with f(value).  For example
+    register_decoder(-11, Side) receives symbol atoms as members of the enum Side"""
+    decoders[qtype] = f
+
+def _encoder(x):
+    t = type(x)
+    if t not in _encoders:
+        _encoders[t] = encoders.get(t)
+        if _encoders[t] is None:
+            for c in t.__mro__:
+                if c in encoders:
+                    _encoders[t] = encoders[c]
+                    break
+    return _encoders[t]
+
+def _zr(f):
+    """literal run lengths and back references (0) announced by the flag byte f of a compressed message"""
+    runs = []
+    n = 0
+    for i in range(8):
+        if f >> i & 1:
+            if n:
+                runs.append(n)
+                n = 0
+            runs.append(0)
+        else:
+            n += 1
+    if n:
+        runs.append(n)
+    return tuple(runs)
+zr = [_zr(f) for f in range(256)]
 
 class timestamp(datetime.datetime):
     def __str__(self):
@@ -48,8 +129,8 @@ class Month:
         self.i = x
     def __str__(self):
         m = self.i + 24000
-        y = m / 12
-        return '%(decade)02d%(year)02d-%(month)02d' % {'decade': y/100, 'year': y % 100, 'month':(m+1)%12}
+        y = m // 12
+        return '%(decade)02d%(year)02d-%(month)02d' % {'decade': y//100, 'year': y % 100, 'month':(m+1)%12}
     def __eq__(self, obj):
         if isinstance(obj, Month) : return obj.i == self.i
         return False
@@ -57,7 +138,7 @@ class Minute:
     def __init__(self, x):
         self.i = x
     def __str__(self):
-        return '%(hour)02d:%(minute)02d' % {'hour': self.i/60, 'minute': self.i % 60}
+        return '%(hour)02d:%(minute)02d' % {'hour': self.i//60, 'minute': self.i % 60}
     def __eq__(self, obj):
         if isinstance(obj, Minute) : return obj.i == self.i
         return False
@@ -65,17 +146,21 @@ class Second:
     def __init__(self, x):
         self.i = x
     def __str__(self):
-        return '%(minute)s:%(second)02d' % {'minute': str(Minute(self.i/60)), 'second': self.i % 60}
+        return '%(minute)s:%(second)02d' % {'minute': str(Minute(self.i//60)), 'second': self.i % 60}
     def __eq__(self, obj):
         if isinstance(obj, Second) : return obj.i == self.i
         return False
 class Dict:
     """Dict is a generalized dict.  It just contains the keys and values as two objects and provides a way to 
-    interact with it."""
+    interact with it.  d[key] looks key up through a hash index built on first use; the value found in a keyed
+    table, a Dict of two Flips, is a Row of the values table, the key being a tuple when there are several key columns"""
+    __slots__ = ('x', 'y', 'length', 'index', 'lookup')
     def __init__(self, x, y):
         self.x = x
         self.y = y
         self.length = len(x)
+        self.index = 0
+        self.lookup = None  #position of each key, see find
 
     def __len__(self):
         return self.length 
@@ -90,6 +175,7 @@ class Dict:
         k,v = self.x[self.index], self.y[self.index]
         self.index += 1
         return k,v
+    __next__ = next
     def __str__(self):
         string = ""
         for k,v in self:
@@ -99,18 +185,75 @@ class Dict:
     def __eq__(self, obj):
         if isinstance(obj, Dict) : return self.y == obj.y and self.x == obj.x
         return False
+    def find(self, key):
+        """Return the position of the first occurrence of key, or None"""
+        if self.lookup is None:
+            self.lookup = _lookup(self.x.y if isinstance(self.x, Flip) else [self.x])
+        return self.lookup.get(key)
+    def __getitem__(self, key):
+        i = self.find(key)
+        if i is None:
+            raise KeyError(key)
+        return self.y[i]
+    def get(self, key, default=None):
+        i = self.find(key)
+        return default if i is None else self.y[i]
+    def __contains__(self, key):
+        return self.find(key) is not None
+    def to_pandas(self):
+        """Return a keyed table as a pandas DataFrame indexed by its key columns, any other dictionary as a Series"""
+        if isinstance(self.x, Flip) and isinstance(self.y, Flip):
+            keys = self.x.to_pandas()
+            frame = self.y.to_pandas()
+            if len(keys.columns) == 1:
+                frame.index = _pandas().Index(keys.iloc[:, 0], name=keys.columns[0])
+            else:
+                frame.index = _pandas().MultiIndex.from_frame(keys)
+            return frame
+        return _pandas().Series(_pcolumn(self.y), index=_pcolumn(self.x))
     
 class Flip:
     """Flip is a different way to look at table data held in a Dict
-    It assumes that the dictionary contains values which are equal length arrays"""
-    def __init__(self, d):
-        self.x = []  #column names
-        self.y = []  #column data (stored by column)
-        for k,v in d:
-            self.x.append(k)
-            self.y.append(v)
-        self.length = len(self.y[0])
+    It assumes that the dictionary contains values which are equal length arrays.
+    A table decoded lazily holds None for the columns not used yet, and a reader that decodes them from the
+    message on first use: by name through flip['name'], or all at once through flip.y.
+    Rows are Row views reading the columns in place"""
+    __slots__ = ('x', 'cols', 'names', 'reader', 'types', 'keys', 'length', 'index', 'lookup')
+    def __init__(self, d, reader=None, types=None):
+        self.x = list(d.x)  #column names
+        self.cols = list(d.y)  #column data (stored by column)
+        self.names = {name: i for i, name in enumerate(self.x)}  #position of each column
+        self.reader = reader
+        self.types = types  #q type of each column of a table decoded from a message, for to_pandas
+        self.keys = []  #names of the key columns of a keyed table joined by td
+        self.lookup = None  #position of each key, see find
+        if reader is not None:
+            self.length = reader.length
+        elif self.cols:
+            self.length = len(self.cols[0])
+        else:
+            self.length = 0
         self.index = 0
+    @property
+    def y(self):
+        """column data (stored by column)"""
+        if self.reader is not None:
+            for i in range(len(self.cols)):
+                if self.cols[i] is None:
+                    self.cols[i] = self.reader(i)
+            self.reader = None
+        return self.cols
+    @y.setter
+    def y(self, y):
+        self.cols = y
+        self.reader = None
+        self.types = None
+    def column(self, name):
+        """Return the column called name, decoding it first if it has not been used yet"""
+        i = self.names[name]
+        if self.cols[i] is None:
+            self.cols[i] = self.reader(i)
+        return self.cols[i]
     def __len__(self):
         return self.length 
     def __iter__(self):
@@ -120,11 +263,9 @@ class Flip:
         """Return the row"""
         if self.index > self.length-1:
             raise StopIteration
-        row = []
-        for v in self.y:
-            row.append(v[self.index])
         self.index += 1
-        return row
+        return Row(self, self.index - 1)
+    __next__ = next
     def __str__(self):
         string = ""
         for row in self:
@@ -135,37 +276,410 @@ class Flip:
         if isinstance(obj, Flip) : return self.y == obj.y and self.x == obj.x
         return False
     def __getitem__(self, index):
-        row = []
-        for v in self.y:
-            row.append(v[index])
-        return row
+        """Return the row at index, or the column called index when it is a name"""
+        if isinstance(index, str):
+            return self.column(index)
+        if isinstance(index, slice):
+            return [v[index] for v in self.y]
+        if index < 0:
+            index += self.length
+        if not 0 <= index < self.length:
+            raise IndexError('row index out of range')
+        return Row(self, index)
+    def find(self, key):
+        """Return the position of the first row of a keyed table joined by td whose key columns hold key, or None"""
+        if self.lookup is None:
+            self.lookup = _lookup([self.column(name) for name in self.keys])
+        return self.lookup.get(key)
+    def to_pandas(self):
+        """Return the table as a pandas DataFrame, indexed by its key columns when it is a keyed table joined by td.
+        Columns not decoded yet are decoded straight from the message into numpy arrays, datetime64 and
+        categoricals, without a Python object per item"""
+        cols = []
+        types = self.types or [None] * len(self.cols)
+        for i, col in enumerate(self.cols):
+            cols.append(_pcolumn(self.reader.numpy(i) if col is None else col, types[i]))
+        frame = _pandas().DataFrame(dict(zip(self.x, cols)), copy=False)
+        if self.keys:
+            frame = frame.set_index(self.keys)
+        return frame
+
+class Row:
+    """row i of a Flip, read from the columns of the table rather than copied out of them"""
+    __slots__ = ('flip', 'i')
+    def __init__(self, flip, i):
+        self.flip = flip
+        self.i = i
+    def __len__(self):
+        return len(self.flip.x)
+    def __getitem__(self, j):
+        """Return the value of column j, a position or a name"""
+        if isinstance(j, str):
+            return self.flip.column(j)[self.i]
+        if isinstance(j, slice):
+            return [v[self.i] for v in self.flip.y[j]]
+        return self.flip.y[j][self.i]
+    def __iter__(self):
+        i = self.i
+        return (v[i] for v in self.flip.y)
+    def tolist(self):
+        i = self.i
+        return [v[i] for v in self.flip.y]
+    def __eq__(self, obj):
+        if isinstance(obj, Row): return self.tolist() == obj.tolist()
+        if isinstance(obj, list): return self.tolist() == obj
+        return False
+    def __repr__(self):
+        return repr(self.tolist())
+
+def _lookup(cols):
+    """position of the first row holding each key of the key columns cols, a key being a value of the only column
+    or a tuple of values of each"""
+    cols = [x.tolist() if isinstance(x, Syms) or numpy is not None and isinstance(x, numpy.ndarray) else x for x in cols]
+    keys = cols[0] if len(cols) == 1 else list(zip(*cols))
+    n = len(keys)
+    return dict(zip(reversed(keys), range(n - 1, -1, -1)))
+
+class Syms:
+    """symbol vector held as codes into its distinct symbols, as decoded when q.symcodes is set"""
+    def __init__(self, codes, symbols):
+        self.codes = codes  #index into symbols of each item, an array('i') or a numpy int32 array when q.numpy is set
+        self.symbols = symbols  #the distinct symbols in order of first appearance
+    def __len__(self):
+        return len(self.codes)
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self.symbols[c] for c in self.codes[i]]
+        return self.symbols[self.codes[i]]
+    def __iter__(self):
+        return iter(self.tolist())
+    def tolist(self):
+        symbols = self.symbols
+        return [symbols[c] for c in self.codes]
+    def __eq__(self, obj):
+        if isinstance(obj, Syms): return self.tolist() == obj.tolist()
+        if isinstance(obj, list): return self.tolist() == obj
+        return False
+    def __str__(self):
+        return str(self.tolist())
+
+class Pending:
+    """response to a query sent with q.kp, read from the connection when it is wanted"""
+
+    def __init__(self, conn, columns, temporal=None):
+        self.conn = conn
+        self.columns = columns
+        self.temporal = temporal
+        self.done = False
+        self.value = None  # the result, or the Exception the query raised
+
+    def wait(self):
+        """read responses up to this one and return its value without raising"""
+        while not self.done:
+            self.conn._readPending()
+        return self.value
+
+    def result(self):
+        x = self.wait()
+        if isinstance(x, Exception):
+            raise x
+        return x
+
+class Prepared:
+    """a query encoded once by q.prepare, called with its arguments: prepared(*args) is conn.k(prepared, args),
+    and prepared.ks(*args) and prepared.kp(*args) are conn.ks and conn.kp.  Each call only encodes the
+    arguments after the bytes kept for the query"""
+    def __init__(self, conn, query, name=False):
+        self.conn = conn
+        self.query = query
+        text = query.encode('latin-1')
+        if name:
+            # a symbol is looked up by the server rather than parsed
+            item = sb.pack(-11) + text + b'\0'
+        else:
+            item = sb.pack(10) + b'\0' + si[0].pack(len(text)) + text
+        self.head = b'\0\0\0\0\0\0' + item  # general list type, attributes and length, then the query
+    def __call__(self, *args):
+        return self.conn.k(self, args)
+    def ks(self, *args):
+        return self.conn.ks(self, args)  # to be awaited on an AsyncQ
+    def kp(self, *args):
+        return self.conn.kp(self, args)
+
+class Call:
+    """a Prepared query with the arguments of one call, as packed for _encode"""
+    def __init__(self, prepared, args):
+        self.prepared = prepared
+        self.args = args
+
+class Columns:
+    """Columns of a table left undecoded in the message they arrived in, decoded one at a time by a copy of the
+    connection that received them"""
+    def __init__(self, decoder, little_endian, buf, offsets, length):
+        self.decoder = decoder
+        self.little_endian = little_endian
+        self.buf = buf
+        self.offsets = offsets  #offset in buf of each column
+        self.length = length
+    def __call__(self, i):
+        self.decoder.offset = self.offsets[i]
+        return self.decoder._r(self.little_endian, self.buf)
+    def numpy(self, i):
+        """decode column i as numpy arrays, datetime64 and symbol codes whatever the connection settings"""
+        decoder = self.decoder
+        settings = decoder.numpy, decoder.temporal, decoder.symcodes
+        decoder.numpy, decoder.temporal, decoder.symcodes = True, 'numpy', True
+        try:
+            return self(i)
+        finally:
+            decoder.numpy, decoder.temporal, decoder.symcodes = settings
     
+class Cache:
+    """results of the synchronous queries q.k is asked to cache, kept while they are fresh, see q.cache.  Each
+    entry lives ttl seconds and the least recently used entries are evicted to keep the size of the messages they
+    came from within size bytes.  A Cache may be shared by several connections; results are shared too, so they
+    must not be modified, and tables decoded lazily are decoded in full before they are kept"""
+    def __init__(self, size=64*1024*1024, ttl=60.0):
+        self.size = size  # most bytes of messages kept
+        self.ttl = ttl  # seconds an entry stays fresh, unless given for the entry
+        self.entries = collections.OrderedDict()  # key: (result, expiry, bytes), least recently used first
+        self.used = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0  # entries dropped to make room
+        self.expired = 0  # entries dropped for being stale
+        self.lock = threading.Lock()
+    def get(self, key):
+        """the fresh entry for key, or None"""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[1] < time.monotonic():
+                self._drop(key)
+                self.expired += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry
+    def put(self, key, result, size, ttl=None):
+        """keep result, decoded from a message of size bytes, for ttl seconds"""
+        ttl = self.ttl if ttl is None else ttl
+        if ttl <= 0 or size > self.size:
+            return
+        with self.lock:
+            if key in self.entries:
+                self._drop(key)
+            while self.entries and self.used + size > self.size:
+                self._drop(next(iter(self.entries)))
+                self.evictions += 1
+            self.entries[key] = (result, time.monotonic() + ttl, size)
+            self.used += size
+    def invalidate(self, prefix=None):
+        """drop the entries whose key starts with prefix, the text of a query or the start of it, or every entry"""
+        if isinstance(prefix, str):
+            prefix = prefix.encode('latin-1')
+        with self.lock:
+            for key in [key for key in self.entries if prefix is None or key.startswith(prefix)]:
+                self._drop(key)
+    def _drop(self, key):
+        self.used -= self.entries.pop(key)[2]
+    def stats(self):
+        """snapshot of the cache counters"""
+        with self.lock:
+            return {'entries': len(self.entries), 'bytes': self.used, 'size': self.size, 'hits': self.hits,
+                    'misses': self.misses, 'evictions': self.evictions, 'expired': self.expired}
+
+class Meter:
+    """instrumentation of a connection, see q.meter: the time spent in each phase of sending and receiving
+    messages, the bytes and messages each way, and a histogram of the latency of k calls.  Each callback added
+    with on is called after every k call with the query, its latency and the seconds spent in each phase of it;
+    with logging at DEBUG for this module, the same is logged"""
+    PHASES = ('encode', 'compress', 'send', 'wait', 'receive', 'decompress', 'decode')
+    BUCKETS = 40  # latency histogram buckets, bucket i counting the calls of less than 2**i microseconds
+    def __init__(self):
+        self.callbacks = []
+        self.reset()
+    def reset(self):
+        self.seconds = dict.fromkeys(self.PHASES, 0.0)  # total time spent in each phase
+        self.sent = 0  # messages sent
+        self.received = 0  # messages received
+        self.encoded = 0  # bytes of the messages sent, before compression
+        self.wire_out = 0  # bytes of the messages sent, as sent
+        self.wire_in = 0  # bytes of the messages received, as received
+        self.decoded = 0  # bytes of the messages received, decompressed
+        self.calls = 0  # k calls
+        self.latency = 0.0  # total seconds of the k calls
+        self.latency_max = 0.0
+        self.histogram = [0] * self.BUCKETS
+        self.call = None  # seconds spent in each phase of the k call in progress
+    def on(self, f):
+        """call f(query, latency, phases) after every k call"""
+        self.callbacks.append(f)
+    def add(self, phase, seconds):
+        self.seconds[phase] += seconds
+        if self.call is not None:
+            self.call[phase] = self.call.get(phase, 0.0) + seconds
+    def begin(self):
+        self.call = {}
+        self.start = time.perf_counter()
+    def end(self, query):
+        latency = time.perf_counter() - self.start
+        phases = self.call
+        self.call = None
+        self.calls += 1
+        self.latency += latency
+        self.latency_max = max(self.latency_max, latency)
+        self.histogram[min(int(latency * 1e6).bit_length(), self.BUCKETS - 1)] += 1
+        for f in self.callbacks:
+            f(query, latency, phases)
+        log = logging.getLogger(__name__)
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug('k %.3f ms %s %s', latency * 1e3, ' '.join('%s %.3f' % (k, v * 1e3) for k, v in phases.items()),
+                      query if isinstance(query, str) else getattr(query, 'query', ''))
+    def percentile(self, p):
+        """upper bound in seconds of the latency of the fraction p of k calls, from the histogram"""
+        n = p * self.calls
+        seen = 0
+        for i, count in enumerate(self.histogram):
+            seen += count
+            if count and seen >= n:
+                return 2 ** i / 1e6
+        return 0.0
+    def stats(self):
+        """snapshot of the counters; times are in seconds"""
+        return {'seconds': dict(self.seconds), 'sent': self.sent, 'received': self.received, 'encoded': self.encoded,
+                'wire_out': self.wire_out, 'wire_in': self.wire_in, 'decoded': self.decoded, 'calls': self.calls,
+                'latency_mean': self.latency / self.calls if self.calls else 0.0, 'latency_max': self.latency_max,
+                'p50': self.percentile(0.5), 'p90': self.percentile(0.9), 'p99': self.percentile(0.99),
+                'histogram': list(self.histogram)}
+
 def td(x):
     """A Dict containing two Flips is how keyed tables are encoded, td joins the 2 Dict objects into a single Flip object"""
     if isinstance(x, Flip): return x
     if not isinstance(x, Dict): raise Exception('This function takes a Dict type')
     a = x.x
     b = x.y
-    x = []
-    for item in a.x: x.append(item)
-    for item in b.x: x.append(item)
-    y = []
-    for item in a.y: y.append(item)
-    for item in b.y: y.append(item)
-    return Flip(Dict(x,y))
+    # the columns are shared, not copied, and value columns not decoded yet are left to decode on first use
+    flip = Flip(Dict(a.x + b.x, a.y + b.cols), types=a.types + b.types if a.types and b.types else None)
+    if b.reader is not None:
+        r = b.reader
+        flip.reader = Columns(r.decoder, r.little_endian, r.buf, [None] * len(a.x) + r.offsets, r.length)
+    flip.keys = list(a.x)
+    return flip
+
+def _settle(x):
+    """decode the columns the lazily decoded tables in x have left, as Columns decode through one shared
+    connection copy and must not be used by several threads at once"""
+    if isinstance(x, Flip):
+        x.y
+    elif isinstance(x, Dict):
+        _settle(x.x)
+        _settle(x.y)
+    elif isinstance(x, list):
+        for v in x:
+            _settle(v)
+
+def _pandas():
+    """pandas, imported on first use as it is optional and slow to import"""
+    try:
+        import pandas
+    except ImportError:
+        raise Exception('pandas is needed for DataFrames')
+    return pandas
+
+def _isframe(x):
+    """whether x is a pandas DataFrame, without importing pandas when the caller has not"""
+    pandas = sys.modules.get('pandas')
+    return pandas is not None and isinstance(x, pandas.DataFrame)
+
+def _pcolumn(x, t=None):
+    """a decoded q vector as a DataFrame column: numpy arrays as they are, array.array viewed without a copy and
+    Syms as categoricals of their codes.  Given the q type t of the vector, symbols, booleans and temporal vectors
+    decoded as Python objects or numbers become the categoricals, bools and datetime64 Flip.to_pandas decodes
+    columns not used yet into"""
+    if isinstance(x, Syms):
+        return _pandas().Categorical.from_codes(x.codes, x.symbols)
+    if t == 11 and isinstance(x, list):
+        return _pandas().Categorical(x)
+    if t in tnu and not (isinstance(x, numpy.ndarray) and x.dtype.kind in 'Mm'):
+        codec = q('localhost', 0, '', 0)  # no attempts: never connected
+        if t in (12, 16) and isinstance(x, list):
+            # nanoseconds, with the null, decoded to the microsecond below the least long, back at it
+            epoch = datetime.datetime(2000,1,1) if t == 12 else datetime.timedelta(0)
+            x = [max((d.days * 86400000000 + d.seconds * 1000000 + d.microseconds) * 1000, -2**63) for d in [v - epoch for v in x]]
+        elif isinstance(x, list):
+            # the numbers q sent, as the encoder writes them
+            codec.remote_ver = 3
+            message = bytearray()
+            codec._wv(t, x, message)
+            x = numpy.frombuffer(message, numpy.dtype(at[t]).newbyteorder('>'))
+        return codec._tnp(t, numpy.asarray(x).astype(at[t]))
+    if isinstance(x, array.array):
+        x = numpy.frombuffer(x, x.typecode)
+    if t == 1:
+        return numpy.asarray(x, bool)
+    return x
+
+def _pseries(x):
+    """the values of the pandas Series x as a numpy array the encoder maps to the matching q vector type"""
+    pandas = _pandas()
+    dtype = x.dtype
+    if isinstance(dtype, pandas.CategoricalDtype):
+        return numpy.asarray(dtype.categories, object)[x.cat.codes.to_numpy()]
+    if isinstance(dtype, pandas.DatetimeTZDtype):
+        return x.dt.tz_convert('UTC').dt.tz_localize(None).to_numpy()
+    if isinstance(dtype, pandas.StringDtype):
+        return x.to_numpy(object, na_value='')
+    if isinstance(dtype, pandas.api.extensions.ExtensionDtype) and hasattr(dtype, 'numpy_dtype'):
+        # nullable columns, with q nulls for the missing values
+        kind = dtype.numpy_dtype.kind
+        null = numpy.iinfo(dtype.numpy_dtype).min if kind in 'iu' else False if kind == 'b' else numpy.nan
+        return x.to_numpy(dtype.numpy_dtype, na_value=null)
+    return x.to_numpy()
+
+def _frame(x):
+    """the pandas DataFrame x as a Flip, or as a keyed table when its index is named"""
+    values = Flip(Dict([str(name) for name in x.columns], [_pseries(x.iloc[:, i]) for i in range(len(x.columns))]))
+    if all(name is None for name in x.index.names):
+        return values
+    return Dict(_frame(x.index.to_frame(index=False)), values)
           
 # 86400000 is number of milliseconds in a day
 # 10957 is days offset between UNIX Epoch and kdb Epoch
-k = 86400000L * 10957
+k = 86400000 * 10957
 STDOFFSET = -time.timezone
+DATE_EPOCH = datetime.date.fromtimestamp(946684800 - STDOFFSET)  #kdb epoch of dates, 946684800 is conversion from UNIX epoch to KDB epoch
+DATETIME_EPOCH = datetime.datetime.fromtimestamp(946684800 - STDOFFSET)  #kdb epoch of datetimes
 
       
 class q:
     
     RECONNECT_ATTEMPTS = 5  # Number of reconnect attempts to make before throwing exception
-    RECONNECT_WAIT = 5000 # Milliseconds to wait between reconnect attempts 
+    RECONNECT_WAIT = 5000 # Milliseconds to wait after the first failed reconnect attempt, doubled after each further one
+    CONNECT_TIMEOUT = None # Seconds each connect attempt has to open the socket and log in, None to wait as long as the system does
     MAX_MSG_QUERY_LENGTH = 1024 # Maximum number of characters from query to return in exception message
     MAX_MSG_LIST_LENGTH = 100 # Maximum length of a data list specified in a query before it is summarized in exception message
+    RECV_BUFFER_SIZE = 65536 # Initial size in bytes of the per connection receive buffer
+    MAX_RECV_BUFFER = 64 * 1024 * 1024 # Receive buffers grown past this many bytes are released after each message
+    COMPRESS_THRESHOLD = 2000 # Messages of at most this many bytes are never compressed
+    COMPRESS_RATIO = 2.0 # Messages are sent uncompressed unless compression shrinks them at least this many times
+    COMPRESS_SAMPLE = 1024 * 1024 # Bytes compressed before giving up on a message that is not reaching COMPRESS_RATIO
+    PIPELINE_BYTES = 65536 # Bytes of queries k_many sends ahead of the responses it has read
+    SYM_CACHE = 100000 # Most distinct symbols a connection keeps interned across messages
+    MAX_MSG = 2**31 - 1 # Longest message the signed length in the IPC header can describe
+    UPLOAD_BYTES = 16 * 1024 * 1024 # Bytes of table rows upload sends in each message
+    UPLOAD_INFLIGHT = 8 # Most messages upload sends ahead of the last one the server is known to have handled
+    UPLOAD_SYNC = 4 # upload sends every UPLOAD_SYNC-th message synchronously, as a barrier and error check
+    # q lambdas upload applies func[name; rows] with: asynchronous chunks under protection, their errors kept in
+    # .qpy.failed by the handle of the client, as q reports none for them, and synchronous ones only after raising
+    # and clearing the errors of that client; and the query clearing them when an upload fails
+    UPLOAD_APPLY = ('{[f;t;x]@[value[f][t];x;{e:@[get;`.qpy.failed;()!()];'
+                    '.qpy.failed:e,(enlist .z.w)!enlist $[.z.w in key e;e .z.w;()],enlist x}]}')
+    UPLOAD_CHECK = ('{[f;t;x]e:@[get;`.qpy.failed;()!()];m:$[.z.w in key e;e .z.w;()];.qpy.failed:(enlist .z.w)_e;'
+                    '$[count m;\'"upload: ",(string count m)," chunks failed, the first with ",first m;value[f][t;x]]}')
+    UPLOAD_CLEAR = '.qpy.failed:(enlist .z.w)_@[get;`.qpy.failed;()!()];'
 
     def lg(self, x):
         """local time to UTC offset"""
@@ -175,57 +689,107 @@ class q:
         """UTC to local time offset"""
         return x - STDOFFSET
 
-    def __init__(self, host, port, user):
+    def __init__(self, host, port, user, attempts=1):
         self.host=host
         self.port=port
         self.user=user
         self.remote_ver = 0
         self.compress = False
         self.localhost = False
+        self.numpy = False  # decode numeric vectors to numpy arrays instead of array.array
+        self.lazy = False  # decode table columns only when they are first used
+        self.symcodes = False  # decode symbol vectors as Syms, codes into their distinct symbols, instead of lists
+        self.symcache = {}  # symbols decoded on this connection, so that repeated ones share one string
+        self.temporal = 'object'  # temporal vectors as 'object' (datetime etc), 'raw' (offsets from the kdb epoch) or 'numpy' (datetime64/timedelta64)
+        self.columns = None  # names of the table columns to decode, set by k for the duration of a query
         self.offset = 0
-        self.sock=socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.connect()
+        self.decoded = 0  # bytes of the last message decoded, decompressed, which a cached result is counted as
+        self.rbuf = bytearray(self.RECV_BUFFER_SIZE)  # reused for every message received on this connection
+        self.pending = collections.deque()  # queries sent by kp whose responses have not been read, oldest first
+        self.incoming = collections.deque()  # messages the server sent by itself while responses were being read
+        self.cache = None  # a Cache of the results of k called with cache set, None not to cache
+        self.meter = None  # a Meter timing and counting what goes through the connection, None not to
+        self.offload = None  # an Offload decoding large responses in other processes, None to decode them all here
+        self.sock=None
+        self.connect(attempts)
         
     def close(self):
         self.sock.close()
         
-    def connect(self, attempts=1):
+    def _open(self, timeout):
+        # a socket whose connect failed cannot be connected again, so every attempt gets a new one
+        self.sock=socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.settimeout(timeout)
+        self.sock.connect((self.host,self.port))
+        self._tune()
+        
+    def _tune(self):
+        # check if local address
+        if(((self.sock.getsockname()[0]) == (self.sock.getpeername()[0])) or 
+           ((self.sock.getsockname()[0]) == '127.0.0.1' ) or
+           ((self.sock.getsockname()[0]) == 'localhost' )):
+            self.localhost = True
+        
+        # check and turn on TCP Keepalive
+        x = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE)
+        if (x == 0):
+            x = self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        
+    def connect(self, attempts=1, deadline=None):
+        """connect and log in, waiting RECONNECT_WAIT ms after the first failed attempt and doubling the wait after each further one.
+        With deadline, a time.time(), the attempts, the waits between them and each attempt's CONNECT_TIMEOUT end by then"""
         if self.host=='' :
             raise Exception('bad host')
+        wait = self.RECONNECT_WAIT
         for attempt in range(attempts):
+            timeout = self.CONNECT_TIMEOUT
+            if deadline is not None:
+                left = max(deadline - time.time(), 0.001)
+                timeout = left if timeout is None else min(timeout, left)
             try:
-                self.sock.connect((self.host,self.port))
-                
-                # check if local address
-                if(((self.sock.getsockname()[0]) == (self.sock.getpeername()[0])) or 
-                   ((self.sock.getsockname()[0]) == '127.0.0.1' ) or
-                   ((self.sock.getsockname()[0]) == 'localhost' )):
-                    self.localhost = True
-                
-                # check and turn on TCP Keepalive
-                x = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE)
-                if (x == 0):
-                    x = self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+                self._open(timeout)
                 
                 login = array.array('B')  #signed char array (bytes)
-                login.fromstring(self.user + "\3")
+                login.frombytes((self.user + "\3").encode('latin-1'))
                 login.append(0) #null terminated string
-                self.sock.send(login.tostring())
+                self.sock.sendall(login.tobytes())
                 result = self.sock.recv(1)  #blocking recv
                 if not result:
+                    self.sock.close()
+                    self._open(timeout)
                     login = array.array('B')  #signed char array (bytes)
-                    login.fromstring(self.user)
+                    login.frombytes(self.user.encode('latin-1'))
                     login.append(0) #null terminated string
-                    self.sock.send(login.tostring())
+                    self.sock.sendall(login.tobytes())
                     result = self.sock.recv(1)  #blocking recv
                     if not result:
                         raise Exception("access denied")
                 
-                self.remote_ver = ord(result[0])
-                
+                self.remote_ver = result[0]
+                self.sock.settimeout(None)
+                return
                 
             except Exception as e:
-                raise Exception ('unable to connect to host: ' + str(type(e)) + ':' + e.message)
+                if self.sock is not None:
+                    self.sock.close()
+                if attempt == attempts - 1 or deadline is not None and time.time() + wait / 1000.0 >= deadline:
+                    raise Exception ('unable to connect to host: ' + str(type(e)) + ':' + str(e))
+                time.sleep(wait / 1000.0)
+                wait *= 2
+        
+    def reconnect(self, deadline=None):
+        """replace a broken connection, backing off between up to RECONNECT_ATTEMPTS attempts, ending by deadline if given"""
+        if self.sock is not None:
+            self.sock.close()
+        self.connect(self.RECONNECT_ATTEMPTS, deadline)
+        
+    def alive(self):
+        """check without a round trip that an idle connection is still usable; nothing should be
+        waiting to be read on it, so a readable socket has been closed by the host or is out of step"""
+        try:
+            return not select.select([self.sock], [], [], 0)[0]
+        except (OSError, ValueError):
+            return False
         
     def ns(self, str):
         if str=='' or str==None:
@@ -236,65 +800,49 @@ class q:
     def n(self, x):
         if isinstance(x, Dict):
             return self.n(x.x)
-        elif isinstance(x, array.array) or isinstance(x, list):
+        elif isinstance(x, (array.array, list, bytes, bytearray)):
+            return len(x)
+        elif numpy is not None and isinstance(x, numpy.ndarray):
             return len(x)
         else:
             return 1
     
-    def _nx(self, x):
-        qtype = self._qtype(x)
-        if qtype == 99:
-            return 1 + self._nx(x.x) + self._nx(x.y)
-        if qtype == 98:
-            return 3 + self._nx(x.x) + self._nx(x.y)
-        if qtype < 0:
-            if qtype == -11:
-                return 2+len(x)
-            else:
-                return 1 + nt[-qtype]
-        j = 6
-        n = self.n(x)
-        if qtype == 0 or qtype == 11:
-            for i in range(0, n):
-                if qtype == 0:
-                    j += self._nx(x[i])
-                else:
-                    1 + len(x[i])
-        else :
-            j += n * nt[qtype];
-        return j;
-    
     def _qtype(self, x):
         """Encode the type of x as an integer that is interpreted by q"""
-        #TODO figure out how to deal with array types
-        if isinstance(x, list):return 0
+        if encoders and _encoder(x) is not None:
+            return self._qtype(_encoder(x)(x))
+        if isinstance(x, list):return self._ltype(x)
+        if isinstance(x, (bytes, bytearray)):
+            # a numpy bytes scalar of one byte is a char atom, like any other numpy scalar
+            return -10 if numpy is not None and isinstance(x, numpy.bytes_) and len(x) == 1 else 10
 
         if isinstance(x, array.array):
-            if x.typecode == 'c':
-                return 10
-            elif x.typecode == 'h':
-                return 10
-            elif x.typecode == 'i':
-                return 6
-            elif x.typecode == 'l':
-                return 7
-            elif x.typecode == 'f':
-                return 8
-            elif x.typecode == 'd':
-                return 8
-            else:
-                return 0
+            return aqt.get((x.typecode, x.itemsize), 0)
+
+        if numpy is not None and isinstance(x, numpy.ndarray):
+            kind = x.dtype.kind
+            if kind in 'Mm':
+                return nqu.get((kind, numpy.datetime_data(x.dtype)[0]), 12 if kind == 'M' else 16)
+            if kind == 'U':
+                return 11
+            if kind == 'O':
+                return self._ltype(x)
+            t = nqt.get((kind, x.dtype.itemsize))
+            if t is None:
+                raise Exception('unsupported dtype ' + str(x.dtype))
+            return t
+
+        if numpy is not None and isinstance(x, numpy.generic) and not isinstance(x, (str, bytes)):
+            return -self._qtype(x.reshape(1))
                                     
         if isinstance(x,bool):
             return -1
         elif isinstance(x,UUID):
             return -2
         elif isinstance(x,int):
-            return -6
-        elif isinstance(x,float):
-            return -8
-        elif isinstance(x,long):
             return -7
+        elif isinstance(x,float):
+            return -9
         elif isinstance(x,str):
             return -11
         elif isinstance(x,timestamp):
@@ -317,347 +865,807 @@ class q:
             return 98
         elif isinstance(x,Dict):
             return 99
+        elif _isframe(x):
+            return 98 if all(name is None for name in x.index.names) else 99
         else:
             return 0
     
+    def _ltype(self, x):
+        """A list is a typed vector when all its items are atoms of the same type, otherwise it is a general list"""
+        if len(x) == 0 or len(set(map(type, x))) != 1:
+            return 0
+        t = self._qtype(x[0])
+        if t >= 0 or t == -10:
+            return 0
+        return -t
+    
     def _wb(self, x, message):
-        message.fromstring(struct.pack('b', x))
+        message.extend(sb.pack(x))
         
     def _wg(self, x, message):
         if( self.remote_ver < 3 ):
             raise Exception("KDB 3.0 needed for UUID support")
-        message.fromstring(x.bytes)
+        message.extend(x.bytes)
     
     def _wc(self, x, message):
-        message.fromstring(struct.pack('c', x))
+        message.extend(x[:1])
     
     def _wi(self, x, message):
-        message.fromstring(struct.pack('>i', x))
+        message.extend(si[0].pack(x))
     
     def _wd(self, x, message):
-        message.fromstring(struct.pack('>i', x.toordinal() - datetime.date(2000, 1, 1).toordinal()))
+        message.extend(si[0].pack(x.toordinal() - datetime.date(2000, 1, 1).toordinal()))
         
     def _wdt(self, x, message):
-        message.fromstring(struct.pack('>d', (self.lg( time.mktime(x.timetuple())+(x.microsecond/1000000.) )*1000. -k) / 8.64e7 ))
+        message.extend(sf[0].pack((self.lg( time.mktime(x.timetuple())+(x.microsecond/1000000.) )*1000. -k) / 8.64e7 ))
 
     def _wp(self, x, message):
         if( self.remote_ver < 3 ):
             raise Exception("KDB 3.0 needed for Timestamp support")    
         d = (x - datetime.datetime(2000,1,1) )
-        val = (long((d.days * 24 * 3600) + (d.seconds)) * 1000000) + d.microseconds
-        message.fromstring(struct.pack('>q', val*1000))
+        val = (((d.days * 24 * 3600) + (d.seconds)) * 1000000) + d.microseconds
+        message.extend(sj[0].pack(val*1000))
     
     def _wn(self, x, message):
         if( self.remote_ver < 3 ):
             raise Exception("KDB 3.0 needed for Timespan support")    
-        val = (long((x.days * 24 * 3600) + (x.seconds)) * 1000000) + x.microseconds
-        message.fromstring(struct.pack('>q', val* 1000))
+        val = (((x.days * 24 * 3600) + (x.seconds)) * 1000000) + x.microseconds
+        message.extend(sj[0].pack(val* 1000))
     
     def _wt(self, x, message):
-        message.fromstring(struct.pack('>i', ( x.hour*3600 + x.minute*60 + x.second + (x.microsecond+100)/1000000. )*1000. ))
+        message.extend(si[0].pack(int(( x.hour*3600 + x.minute*60 + x.second + (x.microsecond+100)/1000000. )*1000.)))
     
     def _we(self, x, message):
-        message.fromstring(struct.pack('>f', x))
+        message.extend(se[0].pack(x))
     
     def _wj(self, x, message):
-        message.fromstring(struct.pack('>q', x))
+        message.extend(sj[0].pack(x))
     
     def _wf(self, x, message):
-        message.fromstring(struct.pack('>d', x))
+        message.extend(sf[0].pack(x))
     
     def _wh(self, x, message):
-        message.fromstring(struct.pack('>h', x))
+        message.extend(sh[0].pack(x))
     
     def _ws(self, x, message):
-        message.fromstring(x)
-        message.fromstring(struct.pack('b',0))
+        message.extend(x.encode('latin-1'))
+        message.append(0)
     
     def _wdict(self, x, message):
         self._write(x.x, message)
         self._write(x.y, message)
         
     def _wmms(self, x, message):
-        message.fromstring(struct.pack('>i', x.i))
+        message.extend(si[0].pack(x.i))
         
+    writers = { -1: _wb, -2: _wg, -4: _wb, -5: _wh, -6: _wi, -7: _wj, -8: _we, -9: _wf, -10: _wc, -11: _ws,
+                -12: _wp, -13: _wmms, -14: _wd, -15: _wdt, -16: _wn, -17: _wmms, -18: _wmms, -19: _wt }  #atom writers by q type
+
     def _write(self, x, message):
         """determine the type of x and write it to the binary message for output"""
+        if encoders and _encoder(x) is not None:
+            x = _encoder(x)(x)
         t = self._qtype(x)
-        message.fromstring(struct.pack('b', t))
-        writeType = {
-            -1: self._wb,
-            -2: self._wg,            
-            -4: self._wb,
-            -5: self._wh,
-            -6: self._wi,
-            -7: self._wj,
-            -8: self._we,
-            -9: self._wf,
-            -10: self._wc,            
-            -11: self._ws,
-            -12: self._wp,
-            -13: self._wmms,
-            -14: self._wd,
-            -15: self._wdt,
-            -16: self._wn,            
-            -17: self._wmms,
-            -18: self._wmms,
-            -19: self._wt,
-            0: self._write,
-            1: self._wb,
-            2: self._wg,             
-            4: self._wb,
-            5: self._wh,
-            6: self._wi,
-            7: self._wj,
-            8: self._we,
-            9: self._wf,
-            10: self._wc,
-            11: self._ws,
-            12: self._wp,             
-            13: self._wmms,
-            14: self._wd,
-            15: self._wdt,
-            16: self._wn,                        
-            17: self._wmms,
-            18: self._wmms,
-            19: self._wt
-            }
-        
+        message.extend(sb.pack(t))
         if t < 0 :
-            writeType[t](x, message)
+            if numpy is not None and isinstance(x, numpy.generic) and -t in at:
+                message.extend(self._wnp(-t, x.reshape(1)))
+                return
+            self.writers[t](self, x, message)
             return
         
+        if t >= 98 and not isinstance(x, (Flip, Dict)):
+            x = _frame(x)
+        
         if t == 99:
             self._write(x.x, message)
             self._write(x.y, message)
             return
         
-        message.fromstring(struct.pack('b', 0))
+        message.append(0)
         
         if t == 98:
-            message.fromstring(struct.pack('b', 99))
+            message.append(99)
             self._write(x.x, message)
             self._write(x.y, message)
             return
         
         n = self.n(x)
-        message.fromstring(struct.pack('>i', n))
+        message.extend(si[0].pack(n))
         
-        for i in range(0, n):
-            writeType[t](x[i], message)
-            
-    def k(self, query, args=None):
-        global SYNC
-        if isinstance(query, str) and args is None: 
-            self._send(SYNC, array.array('c',query))
+        if t == 0:
+            for i in range(0, n):
+                self._write(x[i], message)
+            return
+        
+        if n > 0:
+            self._wv(t, x, message)
+    
+    def _wv(self, t, x, message):
+        """write the items of the vector x of type t to the binary message in one step"""
+        if encoders and t != 10 and not isinstance(x, array.array) and _encoder(x[0]) is not None:
+            f = _encoder(x[0])
+            x = [f(v) for v in x]
+        if t in (2, 12, 16) and self.remote_ver < 3:
+            raise Exception("KDB 3.0 needed for " + {2: 'UUID', 12: 'Timestamp', 16: 'Timespan'}[t] + " support")
+        if t == 11:
+            if numpy is not None and isinstance(x, numpy.ndarray):
+                x = x.tolist()
+            message.extend(('\0'.join(x) + '\0').encode('latin-1'))
+        elif numpy is not None and isinstance(x, numpy.ndarray):
+            message.extend(self._wnp(t, x))
+        elif t == 10:
+            message.extend(bytes(x))
+        elif isinstance(x, array.array):
+            x = array.array(at[t], x)
+            if LITTLE_ENDIAN:
+                x.byteswap()
+            message.extend(x.tobytes())
+        elif t == 2:
+            message.extend(b''.join([u.bytes for u in x]))
+        elif t < 10:
+            message.extend(struct.pack('>%d%s' % (len(x), pt[t]), *x))
+        elif t == 12:
+            epoch = datetime.datetime(2000,1,1)
+            message.extend(struct.pack('>%dq' % len(x), *[(d.days * 86400000000 + d.seconds * 1000000 + d.microseconds) * 1000 for d in [v - epoch for v in x]]))
+        elif t == 14:
+            epoch = datetime.date(2000, 1, 1).toordinal()
+            message.extend(struct.pack('>%di' % len(x), *[v.toordinal() - epoch for v in x]))
+        elif t == 15:
+            message.extend(struct.pack('>%dd' % len(x), *[(self.lg( time.mktime(v.timetuple())+(v.microsecond/1000000.) )*1000. -k) / 8.64e7 for v in x]))
+        elif t == 16:
+            message.extend(struct.pack('>%dq' % len(x), *[(v.days * 86400000000 + v.seconds * 1000000 + v.microseconds) * 1000 for v in x]))
+        elif t == 19:
+            message.extend(struct.pack('>%di' % len(x), *[int(( v.hour*3600 + v.minute*60 + v.second + (v.microsecond+100)/1000000. )*1000.) for v in x]))
         else:
-            stuff = [array.array('c',query),]
-            for item in args:
-                stuff.append(item)
-            self._send(SYNC, stuff )
-        return self._readFromServer()
+            message.extend(struct.pack('>%di' % len(x), *[v.i for v in x]))
+    
+    def _wnp(self, t, x):
+        """big endian bytes of the numpy array x as q type t"""
+        kind = x.dtype.kind
+        if kind in 'Mm':
+            nulls = numpy.isnat(x)
+            if t == 12:
+                x = x.astype('datetime64[ns]').view('int64') - 946684800000000000
+            elif t == 13:
+                x = x.view('int64') - 360
+            elif t == 14:
+                x = x.view('int64') - 10957
+            elif t == 16:
+                x = x.astype('timedelta64[ns]').view('int64')
+            else:
+                x = x.view('int64')
+            if nulls.any():
+                x = numpy.where(nulls, -2**63 if nt[t] == 8 else -2**31, x)
+        dtype = 'S1' if t == 10 else numpy.dtype(at[t]).newbyteorder('>')
+        return numpy.ascontiguousarray(x, dtype).tobytes()
+            
+    def k(self, query, args=None, columns=None, temporal=None, ttl=None, cache=False):
+        """send a synchronous query and return its result.  When columns is given, tables in the result only
+        hold those columns, in that order, and the bytes of the others are skipped without being decoded.
+        temporal, when given, is used instead of self.temporal for this result.  With cache and self.cache set, a
+        fresh result of the same query is returned without asking the server, and new results are kept for ttl
+        seconds (default cache.ttl); other queries always go to the server"""
+        cache = self.cache if cache else None
+        if cache is not None:
+            key = self._key(query, args, columns, temporal)
+            entry = cache.get(key)
+            if entry is not None:
+                return entry[0]
+        meter = self.meter
+        if meter is not None:
+            meter.begin()
+        try:
+            if self.pending:
+                result = self.kp(query, args, columns, temporal).result()
+            else:
+                self._query(SYNC, query, args)
+                self.columns = columns
+                saved = self.temporal
+                self.temporal = temporal or saved
+                try:
+                    result = self._readFromServer()
+                finally:
+                    self.columns = None
+                    self.temporal = saved
+        finally:
+            if meter is not None:
+                meter.end(query)
+        if cache is not None:
+            if self.lazy:
+                _settle(result)
+            cache.put(key, result, self.decoded, ttl)
+        return result
+
+    def _key(self, query, args, columns, temporal):
+        """cache key of a query: its text, then its encoded args and the settings its result is decoded with"""
+        if isinstance(query, Prepared):
+            query = query.query
+        key = bytearray(query.encode('latin-1'))
+        key.append(0)
+        if args is not None:
+            self._write(list(args), key)
+        key.extend(repr((columns, temporal or self.temporal, self.numpy, self.lazy, self.symcodes)).encode())
+        return bytes(key)
 
     def ks(self, query, args=None):
-        global ASYNC
-        if isinstance(query, str) and args is None: 
-            self._send(ASYNC, array.array('c',query))
-        else:
-            stuff = [array.array('c',query),]
-            for item in args:
-                stuff.append(item)
-            self._send(ASYNC, stuff )
+        self._query(ASYNC, query, args)
+
+    def k_stream(self, query, args=None, rows=65536):
+        """send a synchronous query and return a generator that decodes the response while it is still arriving.
+        A table is yielded column by column, in pieces of at most rows values, as (column name, values) pairs;
+        any other result is yielded once as (None, result).  The generator must be exhausted or closed before the
+        connection is used again; closing it early reads and discards the rest of the response."""
+        self._query(SYNC, query, args)
+        while self.pending:
+            self._readPending()
+        return self._readStream(rows)
+
+    def kp(self, query, args=None, columns=None, temporal=None):
+        """send a synchronous query without waiting for its response and return a Pending for it.  Any number of
+        queries may be sent this way, mixed with ks; kdb answers them in order and result reads the responses
+        up to the one wanted.  k, k_stream and kr on the same connection keep working, reading the outstanding
+        responses first"""
+        self._query(SYNC, query, args)
+        p = Pending(self, columns, temporal)
+        self.pending.append(p)
+        return p
+
+    def k_many(self, queries, columns=None, temporal=None):
+        """run a batch of synchronous queries in about one round trip: they are written back to back, keeping at
+        most PIPELINE_BYTES of them ahead of the responses read so that neither side blocks, and the responses
+        are read in order.  Each item of queries is a query or a (query, args) pair.  Returns a list with the
+        result of each query, or the Exception it raised, so that one failed query does not lose the others"""
+        results = []
+        sent = collections.deque()
+        ahead = 0
+        for x in queries:
+            query, args = (x, None) if isinstance(x, str) else x
+            try:
+                message = self._encode(SYNC, self._pack(query, args))
+            except Exception as e:
+                results.append(e)
+                continue
+            while sent and ahead + len(message) > self.PIPELINE_BYTES:
+                p, n = sent.popleft()
+                p.wait()
+                ahead -= n
+            self.sock.sendall(message)
+            p = Pending(self, columns, temporal)
+            self.pending.append(p)
+            results.append(p)
+            sent.append((p, len(message)))
+            ahead += len(message)
+        return [p if isinstance(p, Exception) else p.wait() for p in results]
+
+    def upload(self, name, table, func='insert', size=None, inflight=None, every=None):
+        """send table, a Flip, a keyed table, a DataFrame or a dict of columns, to the table called name on the
+        server as func[`name; rows] messages of rows of about size bytes each (default UPLOAD_BYTES), so that
+        no message nears the 2GB limit and only one chunk is encoded at a time.  The chunks are sent
+        asynchronously except every every-th one (default UPLOAD_SYNC) and the last, which are sent synchronously:
+        their responses show the server has handled the chunks before them, and raise an error if any of those
+        failed, kept on the server by UPLOAD_APPLY, or if they fail themselves.  At most inflight chunks (default
+        UPLOAD_INFLIGHT) are sent ahead of the last response read.  Returns the number of rows sent"""
+        size = size or self.UPLOAD_BYTES
+        inflight = inflight or self.UPLOAD_INFLIGHT
+        every = min(every or self.UPLOAD_SYNC, inflight)  # so that one of any inflight chunks in a row is synchronous
+        if isinstance(table, dict):
+            table = Flip(Dict(list(table), list(table.values())))
+        elif _isframe(table):
+            table = _frame(table)
+        table = td(table)
+        names = table.x
+        cols = table.y
+        n = len(table)
+        # bytes per row estimated from the first rows, keeping well below the 2GB limit
+        sample = bytearray()
+        self._write(Flip(Dict(names, [c[:1000] for c in cols])), sample)
+        width = len(sample) / max(min(n, 1000), 1)
+        rows = max(1, int(min(size, self.MAX_MSG / 2) / width))
+        barriers = collections.deque()  # Pending of each synchronous chunk not known to be handled, and its number
+        handled = 0  # chunks before this one are known to have been handled
+        i = 0
+        start = 0
+        try:
+            while start < n or i == 0:
+                end = min(n, start + rows)
+                sync = end == n or (i + 1) % every == 0
+                chunk = Flip(Dict(names, [c[start:end] for c in cols]))
+                # func goes as a string, for the lambda to evaluate whether it names a function or is one
+                message = self._encode(sync, self._pack(self.UPLOAD_CHECK if sync else self.UPLOAD_APPLY,
+                                                        [func.encode('latin-1'), name, chunk]))
+                while barriers and i - handled >= inflight:
+                    p, j = barriers.popleft()
+                    p.result()
+                    handled = j + 1
+                self.sock.sendall(message)
+                if sync:
+                    p = Pending(self, None, None)
+                    self.pending.append(p)
+                    barriers.append((p, i))
+                del message, chunk
+                start = end
+                i += 1
+            while barriers:
+                barriers.popleft()[0].result()
+        except:
+            # the responses still due are read so that the connection stays usable, and the errors of the chunks
+            # sent after the failure are cleared so that the next upload does not raise them
+            for p, j in barriers:
+                p.wait()
+            try:
+                self.k(self.UPLOAD_CLEAR)
+            except Exception:
+                pass
+            raise
+        return n
 
     def kr(self):
+        """read the next message sent by the server"""
+        while not self.incoming and self.pending:
+            self._readPending()
+        if self.incoming:
+            x = self.incoming.popleft()
+            if isinstance(x, Exception):
+                raise x
+            return x
         return self._readFromServer()
 
     def qt(self,x):
-        return _qtype(x)
+        return self._qtype(x)
+
+    def _query(self, sync, query, args):
+        self._send(sync, self._pack(query, args))
+
+    def prepare(self, query, name=False):
+        """return a Prepared for query, which encodes the query text once for all its calls.  With name set,
+        query is the name of a function on the server and is sent as a symbol, so that it is not parsed"""
+        return Prepared(self, query, name)
+
+    def _pack(self, query, args):
+        """query on its own as a char vector, or a list of the query followed by args"""
+        if isinstance(query, Prepared):
+            return Call(query, args or ())
+        if isinstance(query, str) and args is None: 
+            return query.encode('latin-1')
+        else:
+            stuff = [query.encode('latin-1'),]
+            for item in args:
+                stuff.append(item)
+            return stuff
 
     def _send(self, sync, query):
-        n = self._nx(query) + 8
+        message = self._encode(sync, query)
+        meter = self.meter
+        if meter is None:
+            self.sock.sendall(message)
+            return
+        start = time.perf_counter()
+        self.sock.sendall(message)
+        meter.add('send', time.perf_counter() - start)
+       
+    def _encode(self, sync, query):
+        """the whole message carrying query, compressed when that is worthwhile.  The message is written in one
+        pass, its length being filled in once it is known"""
+        meter = self.meter
+        if meter is not None:
+            start = time.perf_counter()
         if sync:
-            message = array.array('B', [0,1,0,0]) # 1 for synchronous requests
+            message = bytearray(b'\0\1\0\0\0\0\0\0') # 1 for synchronous requests
+        else:
+            message = bytearray(8)
+        if isinstance(query, Call):
+            message.extend(query.prepared.head)
+            si[0].pack_into(message, 10, len(query.args) + 1)
+            for x in query.args:
+                self._write(x, message)
         else:
-            message = array.array('B', [0,0,0,0]) # 1 for synchronous requests
-        message.fromstring(struct.pack('>i', n)) # n is the total lengh of the message ( in bytes)
-        self._write(query, message)
-        if self.compress and (len(message) > 2000) and not self.localhost:
-            self._z(message)
-        #print ("[WRITE] KDB - message size: " + str(sys.getsizeof(message)))
-        self.sock.send(message.tostring())
+            self._write(query, message)
+        if len(message) > self.MAX_MSG:
+            raise Exception('message of %d bytes is past the 2GB IPC limit' % len(message))
+        struct.pack_into('>i', message, 4, len(message)) # the total length of the message ( in bytes)
+        if meter is not None:
+            encoded = time.perf_counter()
+            meter.add('encode', encoded - start)
+            meter.sent += 1
+            meter.encoded += len(message)
+        if self.compress and (len(message) > self.COMPRESS_THRESHOLD) and not self.localhost and self.remote_ver > 0:
+            message = self._z(message)
+            if meter is not None:
+                meter.add('compress', time.perf_counter() - encoded)
+        if meter is not None:
+            meter.wire_out += len(message)
+        return message
        
     def _readFromServer(self):
         """read the response from the server"""
-        header = self.sock.recv(8)
-        little_endian = struct.unpack('b', header[0:1])[0] == 1  #byte order
-        zip = struct.unpack('b', header[2:3])[0] == 1  #compression
-        self.offset = 4
-        dataSize = self._ri(little_endian, header)
+        little_endian, zip, msgtype, dataSize = self._readHeader()
+        if self.offload is not None and dataSize >= self.offload.threshold:
+            return self.offload.decode(self, little_endian, zip, dataSize)
         
-        inputBytes = self.recv_size(self.sock, dataSize - 8)
-        #print ("[READ] KDB - message size: " + str(sys.getsizeof(header+inputBytes)))
+        try:
+            inputBytes = self._readBody(dataSize)
+            return self._decode(little_endian, zip, inputBytes[:dataSize])
+        finally:
+            if len(self.rbuf) > self.MAX_RECV_BUFFER:
+                self.rbuf = bytearray(self.RECV_BUFFER_SIZE)
+    
+    def _readHeader(self):
+        """read the header of the next message: its byte order, compression flag, message type and size"""
+        meter = self.meter
+        if meter is not None:
+            start = time.perf_counter()
+        header = self.recv_size(self.sock, 8)
+        if meter is not None:
+            meter.add('wait', time.perf_counter() - start)
+        little_endian = header[0] == 1  #byte order
+        self.offset = 4
+        return little_endian, header[2] == 1, header[1], self._ri(little_endian, header)
+
+    def _readBody(self, size):
+        """read the rest of the message of size bytes whose header has been read, into the receive buffer"""
+        meter = self.meter
+        if meter is None:
+            return self.recv_size(self.sock, size - 8, 8)
+        start = time.perf_counter()
+        buf = self.recv_size(self.sock, size - 8, 8)
+        meter.add('receive', time.perf_counter() - start)
+        meter.received += 1
+        meter.wire_in += size
+        return buf
+
+    def _readPending(self):
+        """read one message while queries sent by kp wait: a response settles the oldest of them, anything else
+        the server sends is kept for kr.  Errors decoding the message are kept in place of its value"""
+        little_endian, zip, msgtype, dataSize = self._readHeader()
+        p = self.pending.popleft() if msgtype == 2 else None
+        inputBytes = self._readBody(dataSize)
+        saved = self.temporal
+        if p:
+            self.columns = p.columns
+            self.temporal = p.temporal or saved
+        try:
+            x = self._decode(little_endian, zip, inputBytes[:dataSize])
+        except Exception as e:
+            x = e
+        finally:
+            self.columns = None
+            self.temporal = saved
+            if len(self.rbuf) > self.MAX_RECV_BUFFER:
+                self.rbuf = bytearray(self.RECV_BUFFER_SIZE)
+        if p:
+            p.value = x
+            p.done = True
+        else:
+            self.incoming.append(x)
+
+    def _decode(self, little_endian, zip, inputBytes):
+        """decode the whole message in inputBytes, raising the error it carries if any"""
+        meter = self.meter
+        if meter is not None:
+            start = time.perf_counter()
         if zip:
-            inputBytes = self._u(little_endian,inputBytes)
+            inputBytes = self._u(little_endian, inputBytes)
+            if meter is not None:
+                decompressed = time.perf_counter()
+                meter.add('decompress', decompressed - start)
+                start = decompressed
         else:
-            self.offset = 0
+            self.offset = 8
+        self.decoded = len(inputBytes)
+        if meter is not None:
+            meter.decoded += self.decoded
         
-        if struct.unpack('b', inputBytes[0:struct.calcsize('b')])[0] == -128 :
-            self.offset = 1
+        if inputBytes[self.offset] == 128 :
+            self.offset += 1
             raise Exception(self._rs(little_endian, inputBytes))
-        return self._r(little_endian, inputBytes)
-    
-    def recv_size(self, the_socket, size):
-        """read size bytes from the socket."""
-        #data length is packed into 8 bytes
-        total_len=0;total_data=[]
-        sock_data='';recv_size=min(size,8192)
-        while total_len<size:
-            sock_data=the_socket.recv(recv_size)
-            total_data.append(sock_data)
-            total_len=sum([len(i) for i in total_data ])
-        return ''.join(total_data)
-
-    def _endian_decide(self,little_endian,fmt):
-        """pick between two types for conversion based on endianness"""
-        if little_endian:
-            return fmt
-        else:
-            return '>'+fmt
+        if meter is None:
+            return self._r(little_endian, inputBytes)
+        try:
+            return self._r(little_endian, inputBytes)
+        finally:
+            meter.add('decode', time.perf_counter() - start)
     
+    def _readStream(self, rows):
+        """generator behind k_stream.  Fixed width and symbol columns of a table are decoded from a window of the
+        receive buffer, between lo and hi, that is refilled from the socket as the columns are consumed"""
+        header = self.recv_size(self.sock, 8)
+        little_endian = header[0] == 1  #byte order
+        zip = header[2] == 1  #compression
+        self.offset = 4
+        dataSize = self._ri(little_endian, header)
+        left = dataSize - 8 # bytes of the message still on the socket
+        buf = self.rbuf
+        lo = hi = 8
+        
+        def fill(n):
+            """make sure at least n unread bytes are in the window, moving it to the start of the buffer or growing
+            the buffer when they would not fit"""
+            nonlocal buf, lo, hi, left
+            if hi - lo >= n:
+                return
+            if n > hi - lo + left:
+                raise Exception('message ended early')
+            if lo + n > len(buf):
+                if n > len(buf):
+                    grown = bytearray(max(n, 2 * len(buf)))
+                    grown[:hi-lo] = buf[lo:hi]
+                    buf = grown
+                else:
+                    buf[:hi-lo] = buf[lo:hi]
+                hi -= lo
+                lo = 0
+            view = memoryview(buf)
+            while hi - lo < n:
+                got = self.sock.recv_into(view[hi:hi + min(len(buf) - hi, left)])
+                if got == 0:
+                    raise Exception('connection closed by host')
+                hi += got
+                left -= got
+        
+        try:
+            if not zip:
+                fill(1)
+            if zip or buf[lo] != 98:
+                # compressed messages and anything but a table are decoded whole
+                self.rbuf = buf
+                inputBytes = self.recv_size(self.sock, left, hi)
+                left = 0
+                x = self._decode(little_endian, zip, inputBytes[:dataSize])
+                buf = self.rbuf
+                if isinstance(x, Flip):
+                    for i in range(len(x.x)):
+                        yield x.x[i], x.y[i]
+                else:
+                    yield None, x
+                return
+            # 98, attributes, 99, then the column names as a symbol vector and the columns as a general list
+            fill(9)
+            self.offset = lo + 5
+            names = [None] * self._ri(little_endian, memoryview(buf))
+            lo = self.offset
+            for i in range(len(names)):
+                while buf.find(b"\0", lo, hi) < 0:
+                    fill(hi - lo + 1)
+                self.offset = lo
+                names[i] = self._rs(little_endian, buf)
+                lo = self.offset
+            fill(6)
+            lo += 6
+            for i, name in enumerate(names):
+                fill(6)
+                t = buf[lo]
+                if t == 11 or (t < len(nt) and nt[t]):
+                    self.offset = lo + 2
+                    n = self._ri(little_endian, memoryview(buf))
+                    lo = self.offset
+                    k = 0
+                    while True:
+                        m = min(rows, n - k)
+                        if t == 11:
+                            e = 0 # length of the m symbols, counted from lo
+                            for j in range(m):
+                                x = buf.find(b"\0", lo + e, hi)
+                                while x < 0:
+                                    fill(hi - lo + 1)
+                                    x = buf.find(b"\0", lo + e, hi)
+                                e = x - lo + 1
+                            values = self._syms(buf[lo:lo+e-1].decode('latin-1').split('\0') if m else [])
+                            lo += e
+                        else:
+                            fill(m * nt[t])
+                            self.offset = lo
+                            values = self._rv(t, m, little_endian, memoryview(buf))
+                            lo = self.offset
+                        k += m
+                        yield name, values
+                        if k >= n:
+                            break
+                else:
+                    # a column that is not fixed width: decode it and the rest of the table once it has all arrived
+                    fill(left + hi - lo)
+                    self.offset = lo
+                    for name in names[i:]:
+                        values = self._r(little_endian, memoryview(buf))
+                        lo = self.offset
+                        yield name, values
+                    break
+        finally:
+            view = memoryview(buf)
+            while left > 0:
+                got = self.sock.recv_into(view[:min(len(buf), left)])
+                if got == 0:
+                    break
+                left -= got
+            if len(buf) <= self.MAX_RECV_BUFFER:
+                self.rbuf = buf
+            else:
+                self.rbuf = bytearray(self.RECV_BUFFER_SIZE)
+    
+    def recv_size(self, the_socket, size, offset=0):
+        """read size bytes from the socket into the receive buffer at offset and return a memoryview over the buffer.
+        The buffer is grown when the message does not fit, keeping the bytes before offset."""
+        end = offset + size
+        if end > len(self.rbuf):
+            rbuf = bytearray(max(end, 2 * len(self.rbuf)))
+            rbuf[:offset] = self.rbuf[:offset]
+            self.rbuf = rbuf
+        view = memoryview(self.rbuf)
+        while offset < end:
+            n = the_socket.recv_into(view[offset:end])
+            if n == 0:
+                raise Exception('connection closed by host')
+            offset += n
+        return view
+
     def _rb(self, little_endian, bytearray):
         """retrieve byte from bytearray at offset"""
-        val = struct.unpack('b', bytearray[self.offset:self.offset+1])[0]
+        val = sb.unpack_from(bytearray, self.offset)[0]
         self.offset+=1
         return val
         
     def _rg(self, little_endian, bytearray):
         """retrieve byte from bytearray at offset"""
-        val = UUID( bytes=array.array('B',bytearray[self.offset:self.offset+16]).tostring())
-        self.offset+=1
+        val = UUID( bytes=bytes(bytearray[self.offset:self.offset+16]))
+        self.offset+=16
         return val
         
     def _rc(self, little_endian, bytearray):
         """retrieve char from bytearray at offset"""
-        val = struct.unpack('c', bytearray[self.offset:self.offset+1])[0]
+        val = chr(bytearray[self.offset])
         self.offset+=1
         return val
     
     def _ri(self, little_endian, bytearray):
         """retrieve integer from bytearray at offset"""
-        val = struct.unpack(self._endian_decide(little_endian,'i'), bytearray[self.offset:self.offset+4])[0]
+        val = si[little_endian].unpack_from(bytearray, self.offset)[0]
         self.offset+=4
         return val
     
     def _rd(self, little_endian, bytearray):
         """retrieve date from bytearray at offset"""
-        val = struct.unpack(self._endian_decide(little_endian,'i'), bytearray[self.offset:self.offset+4])[0]
+        val = si[little_endian].unpack_from(bytearray, self.offset)[0]
         self.offset+=4
         delta=datetime.timedelta(milliseconds=8.64e7*val)
-        return datetime.date.fromtimestamp(self.gl(946684800L)) + delta  #946684800L is conversion from UNIX epoch to KDB epoch
+        return DATE_EPOCH + delta
     
     def _rt(self, little_endian, bytearray):
         """retrieve time from bytearray at offset"""
-        val = struct.unpack(self._endian_decide(little_endian,'i'), bytearray[self.offset:self.offset+4])[0]
+        val = si[little_endian].unpack_from(bytearray, self.offset)[0]
         self.offset+=4
         return (datetime.datetime.fromordinal(1) + datetime.timedelta(milliseconds=val)).time()
      
     def _rdt(self, little_endian, bytearray):
         """retrieve datetime from bytearray at offset.  kdb stores dates relative to 2000.01.01"""
-        val = struct.unpack(self._endian_decide(little_endian,'d'), bytearray[self.offset:self.offset+8])[0]
+        val = sf[little_endian].unpack_from(bytearray, self.offset)[0]
         self.offset+=8
         delta=datetime.timedelta(milliseconds=8.64e7*val)  #8.64e7 is milliseconds in a day
-        return datetime.datetime.fromtimestamp(self.gl(946684800L)) + delta  #946684800L is conversion from UNIX epoch to KDB epoch
+        return DATETIME_EPOCH + delta
 
     def _rp(self, little_endian, bytearray):
         """retrieve timestamp from bytearray at offset.  kdb stores dates relative to 2000.01.01"""
-        val = struct.unpack(self._endian_decide(little_endian,'q'), bytearray[self.offset:self.offset+8])[0]
+        val = sj[little_endian].unpack_from(bytearray, self.offset)[0]
         self.offset+=8
-        delta=datetime.timedelta(microseconds=long(val/1000))
+        delta=datetime.timedelta(microseconds=val//1000)
         res =  datetime.datetime(2000,1,1) + delta
         return timestamp.combine(res.date(),res.time())
     
     def _rn(self, little_endian, bytearray):
         """retrieve timestamp from bytearray at offset.  kdb stores dates relative to 2000.01.01"""
-        val = struct.unpack(self._endian_decide(little_endian,'q'), bytearray[self.offset:self.offset+8])[0]
+        val = sj[little_endian].unpack_from(bytearray, self.offset)[0]
         self.offset+=8
-        return datetime.timedelta(microseconds=long(val/1000))
+        return datetime.timedelta(microseconds=val//1000)
     
     def _re(self, little_endian, bytearray):
         """retrieve float from bytearray at offset"""
-        val = struct.unpack(self._endian_decide(little_endian,'f'), bytearray[self.offset:self.offset+4])[0]
+        val = se[little_endian].unpack_from(bytearray, self.offset)[0]
         self.offset+=4
         return val
     
     def _rj(self, little_endian, bytearray):
         """retrieve long from bytearray at offset"""
-        val = struct.unpack(self._endian_decide(little_endian,'q'), bytearray[self.offset:self.offset+8])[0]
+        val = sj[little_endian].unpack_from(bytearray, self.offset)[0]
         self.offset+=8
         return val
     
     def _rf(self, little_endian, bytearray):
         """retrieve double from bytearray at offset"""
-        val = struct.unpack(self._endian_decide(little_endian,'d'), bytearray[self.offset:self.offset+8])[0]
+        val = sf[little_endian].unpack_from(bytearray, self.offset)[0]
         self.offset+=8
         return val
     
     def _rh(self, little_endian, bytearray):
         """retrieve integer from bytearray at offset"""
-        val = struct.unpack(self._endian_decide(little_endian,'h'), bytearray[self.offset:self.offset+2])[0]
+        val = sh[little_endian].unpack_from(bytearray, self.offset)[0]
         self.offset+=2
         return val
     
+    def _rmonth(self, little_endian, bytearray):
+        return Month(self._ri(little_endian, bytearray))
+
+    def _rminute(self, little_endian, bytearray):
+        return Minute(self._ri(little_endian, bytearray))
+
+    def _rsecond(self, little_endian, bytearray):
+        return Second(self._ri(little_endian, bytearray))
+
     def _rs(self, little_endian, bytearray):
         """retrieve null terminated string from bytearray"""
-        end = bytearray.find("\0",self.offset)
-        val = bytearray[self.offset:end]
+        end = self._find0(bytearray, self.offset)
+        val = bytes(bytearray[self.offset:end]).decode('latin-1')
         self.offset = end+1
         return val
                    
-    def _r(self, little_endian, bytearray):
-        """General retrieve data from bytearray.  format is type number followed by data""" 
+    readers = { -1: _rb, -2: _rg, -4: _rb, -5: _rh, -6: _ri, -7: _rj, -8: _re, -9: _rf, -10: _rc, -11: _rs,
+                -12: _rp, -13: _rmonth, -14: _rd, -15: _rdt, -16: _rn, -17: _rminute, -18: _rsecond, -19: _rt }  #atom readers by q type
+
+    def _rv(self, t, n, little_endian, bytearray):
+        """retrieve a vector of n fixed width items of type t from bytearray at offset in one step"""
+        start = self.offset
+        self.offset += n * nt[t]
+        if t == 2:
+            return [UUID(bytes=bytes(bytearray[i:i+16])) for i in range(start, self.offset, 16)]
+        if t == 10:
+            return bytes(bytearray[start:self.offset]).decode('latin-1')
+        if self.numpy and numpy is not None and t in npt:
+            dtype = numpy.dtype(npt[t])
+            return numpy.frombuffer(bytearray, dtype.newbyteorder('<' if little_endian else '>'), n, start).astype(dtype)
+        if t > 11 and (self.temporal == 'numpy' or self.temporal == 'raw' and self.numpy):
+            if numpy is None:
+                raise Exception('numpy is needed for temporal vectors as numpy arrays')
+            dtype = numpy.dtype(at[t])
+            val = numpy.frombuffer(bytearray, dtype.newbyteorder('<' if little_endian else '>'), n, start).astype(dtype)
+            return val if self.temporal == 'raw' else self._tnp(t, val)
+        val = array.array(at[t])
+        val.frombytes(memoryview(bytearray)[start:self.offset])
+        if little_endian != LITTLE_ENDIAN:
+            val.byteswap()
+        if t < 10 or self.temporal == 'raw':
+            return val
+        if t == 12:
+            epoch = timestamp(2000,1,1)
+            return [epoch + datetime.timedelta(microseconds=v//1000) for v in val]
+        if t == 13:
+            return [Month(v) for v in val]
+        if t == 14:
+            epoch = DATE_EPOCH
+            return [epoch + datetime.timedelta(days=v) for v in val]
+        if t == 15:
+            epoch = DATETIME_EPOCH
+            return [epoch + datetime.timedelta(milliseconds=8.64e7*v) for v in val]
+        if t == 16:
+            return [datetime.timedelta(microseconds=v//1000) for v in val]
+        if t == 17:
+            return [Minute(v) for v in val]
+        if t == 18:
+            return [Second(v) for v in val]
+        midnight = datetime.datetime.fromordinal(1)
+        return [(midnight + datetime.timedelta(milliseconds=v)).time() for v in val]
+
+    def _tnp(self, t, x):
+        """the numpy datetime64 or timedelta64 array of the q temporal vector x of type t, read as numbers"""
+        if t == 15:
+            nulls = numpy.isnan(x)
+            x = numpy.round(numpy.where(nulls, 0, x) * 8.64e7).astype('int64')
+        else:
+            nulls = x == (-2**63 if nt[t] == 8 else -2**31)
+            x = x.astype('int64')
+        if t in tne:
+            x += tne[t]
+        x[nulls] = -2**63
+        return x.view(tnu[t])
+
+    def _r(self, little_endian, bytearray, custom=True):
+        """General retrieve data from bytearray.  format is type number followed by data.  Values of a type with a
+        registered decoder are passed through it, unless custom is False""" 
         t = self._rb(little_endian, bytearray)
-        readType = {
-            -1: lambda: self._rb(little_endian, bytearray),
-            -2: lambda: self._rg(little_endian, bytearray),            
-            -4: lambda: self._rb(little_endian, bytearray),
-            -5: lambda: self._rh(little_endian, bytearray),
-            -6: lambda: self._ri(little_endian, bytearray),
-            -7: lambda: self._rj(little_endian, bytearray),
-            -8: lambda: self._re(little_endian, bytearray),
-            -9: lambda: self._rf(little_endian, bytearray),
-            -10: lambda: self._rc(little_endian, bytearray),
-            -11: lambda: self._rs(little_endian, bytearray),
-            -12: lambda: self._rp(little_endian, bytearray),
-            -13: lambda: Month(self._ri(little_endian, bytearray)),
-            -14: lambda: self._rd(little_endian, bytearray),
-            -15: lambda: self._rdt(little_endian, bytearray),
-            -16: lambda: self._rn(little_endian, bytearray),            
-            -17: lambda: Minute(self._ri(little_endian, bytearray)),
-            -18: lambda: Second(self._ri(little_endian, bytearray)),
-            -19: lambda: self._rt(little_endian, bytearray),
-            0: lambda: self._r(little_endian, bytearray),
-            2: lambda: self._rg(little_endian, bytearray),                        
-            1: lambda: self._rb(little_endian, bytearray),
-            4: lambda: self._rb(little_endian, bytearray),
-            5: lambda: self._rh(little_endian, bytearray),
-            6: lambda: self._ri(little_endian, bytearray),
-            7: lambda: self._rj(little_endian, bytearray),
-            8: lambda: self._re(little_endian, bytearray),
-            9: lambda: self._rf(little_endian, bytearray),
-            10: lambda: self._rc(little_endian, bytearray),
-            11: lambda: self._rs(little_endian, bytearray),
-            12: lambda: self._rp(little_endian, bytearray),
-            13: lambda: Month(self._ri(little_endian, bytearray)),
-            14: lambda: self._rd(little_endian, bytearray),
-            15: lambda: self._rdt(little_endian, bytearray),
-            16: lambda: self._rn(little_endian, bytearray),            
-            17: lambda: Minute(self._ri(little_endian, bytearray)),
-            18: lambda: Second(self._ri(little_endian, bytearray)),
-            19: lambda: self._rt(little_endian, bytearray)
-            }
+        if custom and decoders and t in decoders:
+            self.offset -= 1
+            return decoders[t](self._r(little_endian, bytearray, False))
         if t < 0 :
             #In this case the value is a scalar
-            if readType.has_key(t) : return readType[t]()
+            if t in self.readers : return self.readers[t](self, little_endian, bytearray)
+            raise Exception('unsupported type %d' % t)
         if t > 99 :
             if t == 100 :
                 self._rs(little_endian, bytearray)
@@ -671,114 +1679,1225 @@ class q:
             return "func"
         
         if t == 99:
-            keys = self._r(little_endian, bytearray)
+            columns = self.columns
+            if columns is not None and bytearray[self.offset] == 98:
+                self.columns = None  # the key columns of a keyed table are kept whatever the projection
+            try:
+                keys = self._r(little_endian, bytearray)
+            finally:
+                self.columns = columns
             values = self._r(little_endian, bytearray)
             return Dict(keys, values)
         
         self.offset+=1;
         
         if t == 98:
-            return Flip(self._r(little_endian, bytearray))
+            return self._rflip(little_endian, bytearray)
         
         n=self._ri(little_endian, bytearray) #length of the array
-        val = []
-        for i in range(0, n):
-            item = readType[t]()
-            val.append( item )
+        if t < len(nt) and nt[t]:
+            return self._rv(t, n, little_endian, bytearray)
+        if t == 11:
+            return self._syms(self._rsplit(n, bytearray))
+        if t == 0:
+            return [self._r(little_endian, bytearray) for i in range(n)]
+        raise Exception('unsupported type %d' % t)
+
+    def _rsplit(self, n, bytearray):
+        """the n null terminated symbols from offset in bytearray, found and split in one step each"""
+        if n == 0:
+            return []
+        start = self.offset
+        buf = bytearray.obj if isinstance(bytearray, memoryview) else bytearray
+        if hasattr(buf, 'count'):
+            count = buf.count
+        else:
+            # other memory, such as the shared memory of an Offload, has each window copied to count in
+            count = lambda sub, i, j: bytes(bytearray[i:j]).count(sub)
+        end = len(bytearray)
+        # widen a window from start until it holds n nulls; the symbols end at the nth
+        e = start
+        c = 0
+        step = 8 * n + 8
+        while c < n:
+            if e >= end:
+                raise Exception('symbol vector runs past the end of the message')
+            x = min(end, e + step)
+            c += count(b"\0", e, x)
+            e = x
+            step = max(step, 16 * (n - c))
+        val = buf[start:e].decode('latin-1').split('\0', n)
+        self.offset = e - len(val.pop())
         return val
+
+    def _syms(self, val):
+        """intern the decoded symbols val through the connection's cache, and make them Syms if symcodes is set"""
+        cache = self.symcache
+        if len(cache) > self.SYM_CACHE:
+            cache.clear()
+        if not self.symcodes:
+            return list(map(cache.setdefault, val, val))
+        index = {}
+        codes = [index.setdefault(x, len(index)) for x in val]
+        codes = numpy.array(codes, 'int32') if self.numpy and numpy is not None else array.array('i', codes)
+        return Syms(codes, list(map(cache.setdefault, index, index)))
     
-    def _z(self, message ):
-        msglen = len(message)
-        tmp = array.array('B',([0]*(msglen/2))) # original header + half size buffer
-        buf = message[0:4] + tmp
-        self._write(len(message),buf) # write len of original buffer
-        s=8;c=12;d=12;f=0;p=0;h=0;s0=0;h0=0;r=0;q=0
-        t = len(message)
-        i = 0
-        a = [0] * 256
-        while( s<t ):
-            if i is 0:
-                if d > (msglen/2) - 17:
-                    return message # if less than 12 bytes to compress just return...
+    def _rflip(self, little_endian, bytearray):
+        """retrieve a table, projected onto self.columns, recording where each column starts and decoding the
+        columns now or, in lazy mode, leaving them to the Flip to decode on first use.  The Flip keeps the q type
+        of each column"""
+        self.offset += 1 # dictionary type
+        symcodes = self.symcodes
+        self.symcodes = False  # the names stay a list to be searched
+        try:
+            names = self._r(little_endian, bytearray)
+        finally:
+            self.symcodes = symcodes
+        self.offset += 6 # general list type, attributes and length
+        if self.columns is None and not self.lazy:
+            # every column, decoded in one pass
+            types = []
+            cols = []
+            for i in range(len(names)):
+                types.append(bytearray[self.offset])
+                cols.append(self._r(little_endian, bytearray))
+            return Flip(Dict(names, cols), types=types)
+        offsets = []
+        for i in range(len(names)):
+            offsets.append(self.offset)
+            self._skip(little_endian, bytearray)
+        end = self.offset
+        if self.columns is not None:
+            keep = [names.index(name) for name in self.columns if name in names]
+        else:
+            keep = range(len(names))
+        offsets = [offsets[i] for i in keep]
+        names = [names[i] for i in keep]
+        types = [bytearray[offset] for offset in offsets]
+        if self.lazy:
+            self.offset = offsets[0] + 2 if offsets else end
+            length = self._ri(little_endian, bytearray) if offsets else 0
+            if not isinstance(bytearray, memoryview):
+                bytearray = memoryview(bytearray)
+            self._keep(bytearray.obj)
+            val = Flip(Dict(names, [None] * len(names)), Columns(copy.copy(self), little_endian, bytearray, offsets, length), types)
+        else:
+            cols = []
+            for offset in offsets:
+                self.offset = offset
+                cols.append(self._r(little_endian, bytearray))
+            val = Flip(Dict(names, cols), types=types)
+        self.offset = end
+        return val
+    
+    def _skip(self, little_endian, bytearray):
+        """move the offset past the next object in bytearray without decoding it"""
+        t = self._rb(little_endian, bytearray)
+        if t < 0:
+            if t == -11:
+                self.offset = self._find0(bytearray, self.offset) + 1
+            elif -t < len(nt):
+                self.offset += nt[-t]
+            return
+        if t > 99:
+            self.offset -= 1
+            self._r(little_endian, bytearray)
+            return
+        if t == 99:
+            self._skip(little_endian, bytearray)
+            self._skip(little_endian, bytearray)
+            return
+        self.offset += 1
+        if t == 98:
+            self._skip(little_endian, bytearray)
+            return
+        n = self._ri(little_endian, bytearray)
+        if t < len(nt) and nt[t]:
+            self.offset += n * nt[t]
+        elif t == 11:
+            self._rsplit(n, bytearray)
+        else:
+            for i in range(n):
+                self._skip(little_endian, bytearray)
+    
+    def _keep(self, buf):
+        """let a decoded result hold on to buf, so that it is no longer reused as the receive buffer"""
+        if buf is self.rbuf:
+            self.rbuf = bytearray(self.RECV_BUFFER_SIZE)
+    
+    def _find0(self, bytearray, offset):
+        """position of the first null byte in bytearray from offset"""
+        buf = bytearray.obj if isinstance(bytearray, memoryview) else bytearray
+        return buf.find(b"\0", offset)
+    
+    def _z(self, message):
+        """compress message with the kdb IPC algorithm.  message is returned unchanged when it does not shrink by
+        COMPRESS_RATIO, or when the first COMPRESS_SAMPLE bytes show it will not"""
+        y = bytes(message)
+        t = len(y)
+        e = int(t / self.COMPRESS_RATIO) # size of the compressed buffer, giving up when it is full
+        if e < 29:
+            return message
+        buf = bytearray(e)
+        buf[0:4] = y[0:4]
+        buf[2] = 1 # compressed
+        buf[8:12] = struct.pack('>i', t) # length of the uncompressed message
+        a = [0] * 256 # last position of each hash of two consecutive bytes
+        z = (int.from_bytes(y[:-1], 'little') ^ int.from_bytes(y[1:], 'little')).to_bytes(t - 1, 'little') # the hashes
+        sample = self.COMPRESS_SAMPLE
+        s=8;c=12;d=12;f=0;h=0;s0=0;h0=0;i=0
+        while s < t:
+            if i == 0:
+                if d > e - 17:
+                    return message
+                if s >= sample:
+                    if d * self.COMPRESS_RATIO > s:
+                        return message
+                    sample = t
                 i = 1
-                buf[c] = (f &0xFF)
+                buf[c] = f
                 c = d
                 d += 1
                 f = 0
-            
-            h=0xFF&(message[s]^message[s+1])
-            p=a[h]
-            g = (s > (t-3)) or (p is 0) or ((message[s]^message[p]) is not 0)
-            if(s0 > 0):
-                a[h0]=s0
-                s0=0
-            if(g):
+            g = s > t - 3
+            if not g:
+                h = z[s]
+                p = a[h]
+                g = p == 0 or y[s] != y[p]
+            if s0 > 0:
+                a[h0] = s0
+                s0 = 0
+            if g:
                 h0 = h
                 s0 = s
-                buf[d]=message[s]
-                d+=1
-                s+=1
+                buf[d] = y[s]
+                d += 1
+                s += 1
             else:
                 a[h] = s
-                f|=i
-                p+=2
-                s+=2
+                f |= i
+                p += 2
+                s += 2
+                # length of the run after the two hashed bytes.  short runs are compared a byte at a time, long ones
+                # by xoring both runs as integers
+                q = s + 255 if t - s > 255 else t
                 r = s
-                q = min(s+255,t)
-                while(message[p] == message[s]) and ((s+1) <q):
-                    s+=1
-                    p+=1
-                s+=1
-                buf[d] = (h& 0xFF)
-                d+=1
-                buf[d] = ((s-r) & 0xFF)
-                d+=1
-            i = (i*2)&0xFF
-        buf[12] = (f&0xFF)
-        tmp = array.array('B')
-        self._write(d,tmp)
-        buf[4:8] = tmp
+                while s < q and y[p] == y[s] and s - r < 8:
+                    s += 1
+                    p += 1
+                if s - r == 8 and s < q:
+                    x = int.from_bytes(y[p:p+q-s], 'little') ^ int.from_bytes(y[s:q], 'little')
+                    s = s + (((x & -x).bit_length() - 1) >> 3) if x else q
+                n = s - r
+                buf[d] = h
+                buf[d+1] = n
+                d += 2
+            i = (i << 1) & 0xFF
+        buf[c] = f
+        buf[4:8] = struct.pack('>i', d)
+        del buf[d:]
         return buf
     
     def _u(self, little_endian, buf):
-        buffer = array.array('b',buf)
-        n=0; r=0; f=0; s=8; p=s
-        i=0
-        self.offset = 0
-        sz = self._ri(little_endian, buffer)
-        dst=[0]*sz
-        d=self.offset
-        aa=[0]*256
-        while s<len(dst):
-            if i is 0:
-                f=0xFF&(buffer[d])
-                d+=1
-                i=1
-            if (f&i)is not 0:
-                r=aa[0xFF&(buffer[d])]
-                d+=1
-                dst[s]=dst[r]
-                s+=1
-                r+=1
-                dst[s]=dst[r]
-                s+=1
-                r+=1
-                n=0xFF&(buffer[d])
-                d+=1
-                for m in range(0,n):
-                    dst[s+m]=dst[r+m]
-            else:
-                dst[s]=buffer[d]
-                s+=1
-                d+=1
-            while p<(s-1):
-                aa[(0xFF&(dst[p]))^(0xFF&(dst[p+1]))]=p
-                p+=1
-            if (f&i)is not 0:
-                s+=n
-                p=s
-            i*=2
-            if(i is 256):
-                i=0
+        """decompress the kdb IPC compressed message in buf into a new buffer and return a memoryview over it.
+        Literals and back references are copied as slices, and the table of byte pair hashes is only brought up
+        to date when a back reference needs it"""
+        src = bytes(buf)
         self.offset = 8
-        return array.array('b',dst)
\ No newline at end of file
+        sz = self._ri(little_endian, src)
+        dst = bytearray(sz)
+        dst[0:8] = src[0:8]
+        dst[2] = 0
+        aa = {} # last position of each hash of two consecutive bytes, filled up to p
+        s=8;p=8;d=12
+        while s < sz:
+            f = src[d]
+            d += 1
+            if f == 0 and sz - s >= 8:
+                # a stretch of flag bytes announcing 8 literals each: copy them with one strided slice per literal
+                k = min((sz - s) >> 3, 4096)
+                w = src[d-1:d-1+9*k:9]
+                k = len(w) - len(w.lstrip(b'\0'))
+                e = d - 1 + 9*k
+                for j in range(8):
+                    dst[s+j:s+8*k:8] = src[d+j:e:9]
+                s += 8*k
+                d = e
+                continue
+            # the unused bits of the last flag byte read as literals past the end of the message, which are cut
+            # off below rather than checked for on every token
+            for n in zr[f]:
+                if n:
+                    dst[s:s+n] = src[d:d+n]
+                    s += n
+                    d += n
+                    continue
+                # back reference: the table has to hold every hashed position before s-1
+                e = s - 1
+                if e - p > 8:
+                    aa.update(zip((int.from_bytes(dst[p:e], 'little') ^ int.from_bytes(dst[p+1:e+1], 'little')).to_bytes(e - p, 'little'), range(p, e)))
+                    p = e
+                while p < e:
+                    aa[dst[p]^dst[p+1]] = p
+                    p += 1
+                r = aa[src[d]]
+                n = src[d+1] + 2
+                d += 2
+                if s - r >= n:
+                    dst[s:s+n] = dst[r:r+n]
+                else:
+                    # the copy overlaps itself, repeating the bytes between r and s
+                    dst[s:s+n] = (dst[r:s] * (n // (s - r) + 1))[:n]
+                if p < s:
+                    aa[dst[p]^dst[p+1]] = p
+                aa[dst[s]^dst[s+1]] = s
+                s += n
+                p = s
+        del dst[sz:]
+        self.offset = 8
+        return memoryview(dst)
+
+
+class QPool:
+    """Bounded pool of q connections to one kdb process, shared between threads.
+
+    A q connection wraps one blocking socket and must only be used by one thread
+    at a time; checkout hands a connection to a single caller until checkin.
+    Idle connections are checked for a closed socket on checkout, and pinged
+    with a round trip when idle for longer than ping_after seconds; broken ones
+    are reconnected with backoff (q.RECONNECT_ATTEMPTS, q.RECONNECT_WAIT), within
+    the checkout timeout when there is one.
+    """
+
+    def __init__(self, host, port, user, size=4, timeout=None, ping_after=30.0, cache=None):
+        self.host = host
+        self.port = port
+        self.user = user
+        self.cache = cache  # a Cache shared by the connections of the pool, None not to cache
+        self.size = size  # most connections open at once
+        self.timeout = timeout  # seconds checkout waits for a free connection, None waits forever
+        self.ping_after = ping_after  # seconds idle before a connection is pinged on checkout, None never pings
+        self.idle = []  # (connection, time of checkin), most recently used last
+        self.live = 0  # connections open or being opened
+        self.closed = False
+        self.lock = threading.Condition()
+        self.checkouts = 0
+        self.waits = 0  # checkouts that found every connection in use
+        self.timeouts = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.peak = 0  # most connections checked out at once
+        self.reconnects = 0
+        self.failures = 0  # connections dropped after failing a check or a query
+
+    def _connect(self, deadline):
+        conn = q(self.host, self.port, self.user, 0)  # no attempts: connected below, by the deadline
+        conn.cache = self.cache
+        conn.connect(q.RECONNECT_ATTEMPTS, deadline)
+        return conn
+
+    def checkout(self, timeout=None):
+        """take a connection, waiting up to timeout (default self.timeout) seconds for one to be free, and for it
+        to be opened or reconnected if need be"""
+        if timeout is None:
+            timeout = self.timeout
+        start = time.time()
+        deadline = None if timeout is None else start + timeout
+        waited = False
+        with self.lock:
+            while True:
+                if self.closed:
+                    raise Exception('pool closed')
+                if self.idle:
+                    conn, used = self.idle.pop()
+                    break
+                if self.live < self.size:
+                    self.live += 1
+                    conn = None
+                    break
+                waited = True
+                left = None if timeout is None else timeout - (time.time() - start)
+                if left is not None and left <= 0:
+                    self.timeouts += 1
+                    raise Exception('timed out waiting for a connection to %s:%s' % (self.host, self.port))
+                self.lock.wait(left)
+            wait = time.time() - start
+            self.checkouts += 1
+            self.waits += waited
+            self.wait_total += wait
+            self.wait_max = max(self.wait_max, wait)
+            self.peak = max(self.peak, self.live - len(self.idle))
+        try:
+            if conn is None:
+                conn = self._connect(deadline)
+            elif not self._check(conn, used):
+                with self.lock:
+                    self.failures += 1
+                    self.reconnects += 1
+                conn.reconnect(deadline)
+        except:
+            with self.lock:
+                self.live -= 1
+                self.lock.notify()
+            raise
+        return conn
+
+    def _check(self, conn, used):
+        if not conn.alive():
+            return False
+        if self.ping_after is not None and time.time() - used > self.ping_after:
+            try:
+                conn.k('::')
+            except Exception:
+                return False
+        return True
+
+    def checkin(self, conn, broken=False):
+        """return a checked out connection; a broken one is closed and its place freed"""
+        with self.lock:
+            if broken or self.closed:
+                self.live -= 1
+                self.failures += broken
+                conn.close()
+            else:
+                self.idle.append((conn, time.time()))
+            self.lock.notify()
+
+    def connection(self, timeout=None):
+        """context manager holding a connection for the body of a with statement"""
+        return _Checkout(self, timeout)
+
+    def k(self, query, args=None, columns=None, ttl=None, cache=False):
+        """run a synchronous query on a pooled connection"""
+        conn = self.checkout()
+        try:
+            result = conn.k(query, args, columns, ttl=ttl, cache=cache)
+        except OSError:
+            self.checkin(conn, True)
+            raise
+        except:
+            # a whole reply has been read after a q error or a decode error, but not after the host closed
+            self.checkin(conn, not conn.alive())
+            raise
+        self.checkin(conn)
+        return result
+
+    def ks(self, query, args=None):
+        """send an asynchronous message on a pooled connection"""
+        conn = self.checkout()
+        try:
+            conn.ks(query, args)
+        except:
+            self.checkin(conn, True)
+            raise
+        self.checkin(conn)
+
+    def stats(self):
+        """snapshot of the pool counters; wait times are in seconds"""
+        with self.lock:
+            return {'size': self.size, 'live': self.live, 'idle': len(self.idle), 'in_use': self.live - len(self.idle),
+                    'peak': self.peak, 'checkouts': self.checkouts, 'waits': self.waits, 'timeouts': self.timeouts,
+                    'wait_total': self.wait_total, 'wait_max': self.wait_max,
+                    'wait_mean': self.wait_total / self.checkouts if self.checkouts else 0.0,
+                    'saturation': float(self.waits) / self.checkouts if self.checkouts else 0.0,
+                    'reconnects': self.reconnects, 'failures': self.failures}
+
+    def close(self):
+        """close the idle connections; those checked out are closed when they are returned"""
+        with self.lock:
+            self.closed = True
+            for conn, used in self.idle:
+                conn.close()
+            self.live -= len(self.idle)
+            self.idle = []
+            self.lock.notify_all()
+
+
+class _Checkout:
+
+    def __init__(self, pool, timeout):
+        self.pool = pool
+        self.timeout = timeout
+        self.conn = None
+
+    def __enter__(self):
+        self.conn = self.pool.checkout(self.timeout)
+        return self.conn
+
+    def __exit__(self, t, e, tb):
+        self.pool.checkin(self.conn, t is not None and (issubclass(t, OSError) or not self.conn.alive()))
+        self.conn = None
+
+
+def _blocking(name):
+    """a method of q that AsyncQ cannot run"""
+    def f(self, *args, **kwargs):
+        raise Exception(name + ' is not available on AsyncQ')
+    f.__name__ = name
+    return f
+
+
+class AsyncQ(q):
+    """q connection driven by asyncio streams, for one event loop to run many queries on many connections.
+
+    Open it with conn = await AsyncQ.open(host, port, user).  k is a coroutine and any number of k
+    calls may be in flight at once: the messages are written back to back and the responses, which
+    kdb sends in the order of the requests, are matched to them by a reader task.  ks only waits for
+    the message to be written.  Messages the server sends by itself (e.g. with neg .z.w) are returned
+    by kr or iterated with async for.  The blocking methods of q (kp, k_many, k_stream, upload, reconnect)
+    raise rather than read the streams behind the reader task.  A Prepared query is awaited when called and
+    by its ks.
+    """
+
+    def __init__(self, host, port, user):
+        q.__init__(self, host, port, user, 0)  # no attempts: the streams are opened by open
+        self.rbuf = bytearray()
+        self.reader = None
+        self.writer = None
+        self.pending = collections.deque()  # (future, columns) of the sync queries waiting for a response, oldest first
+        self.incoming = asyncio.Queue()  # messages sent by the server, then None once the connection is closed
+        self.task = None
+
+    @classmethod
+    async def open(cls, host, port, user, attempts=1):
+        conn = cls(host, port, user)
+        await conn._connect(attempts)
+        return conn
+
+    async def _login(self, login):
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        self.sock = self.writer.get_extra_info('socket')
+        self._tune()
+        self.writer.write((login + '\0').encode('latin-1'))
+        return await self.reader.read(1)
+
+    async def _connect(self, attempts):
+        wait = self.RECONNECT_WAIT
+        for attempt in range(attempts):
+            try:
+                result = await self._login(self.user + '\3')
+                if not result:
+                    self.writer.close()
+                    result = await self._login(self.user)
+                    if not result:
+                        raise Exception("access denied")
+                self.remote_ver = result[0]
+                break
+            except Exception as e:
+                if self.writer is not None:
+                    self.writer.close()
+                if attempt == attempts - 1:
+                    raise Exception ('unable to connect to host: ' + str(type(e)) + ':' + str(e))
+                await asyncio.sleep(wait / 1000.0)
+                wait *= 2
+        self.task = asyncio.ensure_future(self._readLoop())
+
+    def _send(self, sync, query):
+        self.writer.write(memoryview(self._encode(sync, query)))
+
+    async def k(self, query, args=None, columns=None):
+        """send a synchronous query and wait for its result; columns is as for q.k"""
+        if self.task is None or self.task.done():
+            raise Exception('connection closed')
+        self._query(SYNC, query, args)
+        result = asyncio.get_running_loop().create_future()
+        self.pending.append((result, columns))
+        await self.writer.drain()
+        return await result
+
+    async def ks(self, query, args=None):
+        """send an asynchronous message, waiting only until the transport can take more"""
+        self._query(ASYNC, query, args)
+        await self.writer.drain()
+
+    async def kr(self):
+        """wait for the next message sent by the server"""
+        x = await self.incoming.get()
+        if x is None:
+            self.incoming.put_nowait(None)
+            raise Exception('connection closed')
+        if isinstance(x, Exception):
+            raise x
+        return x
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        x = await self.incoming.get()
+        if x is None:
+            self.incoming.put_nowait(None)
+            raise StopAsyncIteration
+        if isinstance(x, Exception):
+            raise x
+        return x
+
+    async def _readLoop(self):
+        try:
+            while True:
+                header = await self.reader.readexactly(8)
+                little_endian = header[0] == 1  #byte order
+                self.offset = 4
+                message = header + await self.reader.readexactly(self._ri(little_endian, header) - 8)
+                if header[1] == 2 and self.pending:
+                    result, self.columns = self.pending.popleft()
+                else:
+                    result = None
+                try:
+                    x = self._decode(little_endian, header[2] == 1, message)
+                except Exception as e:
+                    x = e
+                finally:
+                    self.columns = None
+                if result is None:
+                    self.incoming.put_nowait(x)
+                elif not result.cancelled():
+                    if isinstance(x, Exception):
+                        result.set_exception(x)
+                    else:
+                        result.set_result(x)
+        except (asyncio.IncompleteReadError, OSError):
+            pass
+        finally:
+            self.writer.close()
+            while self.pending:
+                result = self.pending.popleft()[0]
+                if not result.done():
+                    result.set_exception(Exception('connection closed by host'))
+            self.incoming.put_nowait(None)
+
+    def close(self):
+        if self.task is not None:
+            self.task.cancel()
+        if self.writer is not None:
+            self.writer.close()
+
+    kp = _blocking('kp')
+    k_many = _blocking('k_many')
+    k_stream = _blocking('k_stream')
+    upload = _blocking('upload')
+    reconnect = _blocking('reconnect')
+
+
+def _cat(chunks):
+    """join the chunks of a column into one list, array or numpy array"""
+    chunks = [c for c in chunks if len(c)] or [[]]
+    x = chunks[0]
+    if len(chunks) == 1:
+        return x
+    if all(type(c) is type(x) for c in chunks):
+        if isinstance(x, Syms):
+            # the codes of each chunk mapped onto the symbols of all of them
+            index = {}
+            codes = []
+            for c in chunks:
+                remap = [index.setdefault(s, len(index)) for s in c.symbols]
+                codes.append(numpy.asarray(remap, 'int32')[c.codes] if isinstance(c.codes, getattr(numpy, 'ndarray', ())) else
+                             array.array('i', [remap[i] for i in c.codes]))
+            return Syms(_cat(codes), list(index))
+    # the rows of other chunks, such as those added by Publisher.upd, take the type of the first typed chunk
+    if numpy is not None:
+        typed = [c for c in chunks if isinstance(c, numpy.ndarray)]
+        if typed:
+            dtype = typed[0].dtype
+            # strings are left to widen to the longest
+            return numpy.concatenate([numpy.asarray(c, None if dtype.kind in 'US' else dtype) for c in chunks])
+    typed = [c for c in chunks if isinstance(c, array.array)]
+    if typed:
+        x = array.array(typed[0].typecode)
+        for c in chunks:
+            x.extend(c if isinstance(c, array.array) and c.typecode == x.typecode else array.array(x.typecode, c))
+        return x
+    return [v for c in chunks for v in c]
+
+
+class Publisher:
+    """Batches rows for a tickerplant and publishes them as columnar .u.upd messages on a q connection.
+
+    Rows are buffered per table column by column, keeping numpy and array columns as they are.  A table is sent as a single async
+    func[table; columns] message once it holds rows rows, everything is sent once the buffered
+    rows are estimated to take size bytes, and a timer thread sends whatever has waited latency
+    seconds.  sync flushes and then waits for the tickerplant to have handled every message.
+    """
+
+    def __init__(self, conn, rows=10000, size=1024 * 1024, latency=0.1, func='.u.upd'):
+        self.conn = conn
+        self.rows = rows  # rows of one table that trigger sending it
+        self.size = size  # estimated bytes of all buffered rows that trigger sending them
+        self.latency = latency  # seconds rows may wait before the timer sends them, None for no timer
+        self.func = func
+        self.tables = {}  # table name -> for each column, the chunks of its values
+        self.counts = {}  # table name -> buffered rows
+        self.widths = {}  # table name -> estimated bytes of one row
+        self.bytes = 0
+        self.since = None  # time the oldest buffered row was added
+        self.error = None  # exception raised by a send from the timer thread
+        self.closed = False
+        self.lock = threading.Condition()
+        self.sending = threading.Lock()  # taken before lock, keeps messages in the order their rows were added
+        self.messages = 0
+        self.published = 0
+        if latency is not None:
+            self.timer = threading.Thread(target=self._run)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def upd(self, table, row):
+        """buffer one row, a sequence with a value for each column"""
+        with self.lock:
+            cols = self.tables.get(table)
+            if cols is not None and not self.closed:
+                for chunks, x in zip(cols, row):
+                    chunks[-1].append(x)
+                action = self._added(table, 1)
+        if cols is None or self.closed:
+            return self.bulk(table, [[x] for x in row])
+        if action is not None:
+            self.flush(*action)
+
+    def bulk(self, table, columns):
+        """buffer rows given in columnar form, a list of column lists or arrays of equal length"""
+        if self.error is not None:
+            raise self.error
+        with self.lock:
+            if self.closed:
+                raise Exception('publisher closed')
+            cols = self.tables.get(table)
+            if cols is None:
+                # every column ends with a list that rows from upd are appended to
+                cols = self.tables[table] = [[[]] for c in columns]
+                self.counts[table] = 0
+                if table not in self.widths:
+                    sample = bytearray()
+                    self.conn._write([c[:1] for c in columns], sample)
+                    self.widths[table] = len(sample) - 6 - 6 * len(columns)
+            for chunks, x in zip(cols, columns):
+                if type(x) is list:
+                    chunks[-1].extend(x)
+                else:
+                    chunks[-1:] = [chunks[-1], x, []]
+            action = self._added(table, len(columns[0]))
+        if action is not None:
+            self.flush(*action)
+
+    def _added(self, table, n):
+        """count n rows added to table, returning the arguments of the flush they call for, if any"""
+        self.counts[table] += n
+        self.bytes += n * self.widths[table]
+        if self.since is None:
+            self.since = time.time()
+            self.lock.notify()
+        if self.bytes >= self.size:
+            return ()
+        if self.counts[table] >= self.rows:
+            return (table,)
+        return None
+
+    def flush(self, table=None):
+        """send the buffered rows of table, or of every table"""
+        with self.sending:
+            with self.lock:
+                if table is None:
+                    batch = list(self.tables.items())
+                    self.tables = {}
+                    self.counts = {}
+                    self.bytes = 0
+                elif table in self.tables:
+                    batch = [(table, self.tables.pop(table))]
+                    self.bytes -= self.counts.pop(table) * self.widths[table]
+                else:
+                    batch = []
+                if not self.tables:
+                    self.since = None
+            for t, cols in batch:
+                cols = [_cat(chunks) for chunks in cols]
+                self.conn.ks(self.func, [t, cols])
+                self.messages += 1
+                self.published += len(cols[0])
+
+    def sync(self):
+        """flush, then make a round trip: kdb handles messages in order, so every row sent has been handled"""
+        self.flush()
+        with self.sending:
+            self.conn.k('::')
+
+    def _run(self):
+        while True:
+            with self.lock:
+                while not self.closed and (self.since is None or time.time() < self.since + self.latency):
+                    self.lock.wait(None if self.since is None else self.since + self.latency - time.time())
+                if self.closed:
+                    return
+            try:
+                self.flush()
+            except Exception as e:
+                # raised again by the next call from the publishing thread
+                self.error = e
+                with self.lock:
+                    self.closed = True
+                return
+
+    def close(self):
+        """send what is buffered and stop the timer; the connection is left open"""
+        if self.error is None:
+            self.flush()
+        with self.lock:
+            self.closed = True
+            self.lock.notify()
+
+
+class Subscriber:
+    """Consumes the updates a tickerplant publishes to a q connection.
+
+    subscribe calls .u.sub; a reader thread then decodes every message sent on the connection
+    and queues (table, data) for a dispatch thread, which passes them to the callbacks registered
+    with on.  The queue holds at most maxsize updates, and policy says what the reader does when
+    it is full: 'block' stops reading, so the tickerplant buffers for this subscriber, 'drop'
+    discards the oldest update, and 'coalesce' appends the columns of the update to the last one
+    queued for the same table, falling back to 'drop' when there is none or they cannot be joined.
+    """
+
+    POLICIES = ('block', 'drop', 'coalesce')
+
+    def __init__(self, conn, maxsize=10000, policy='block', func='upd'):
+        if policy not in self.POLICIES:
+            raise Exception('policy must be one of ' + ', '.join(self.POLICIES))
+        self.conn = conn
+        self.maxsize = maxsize
+        self.policy = policy
+        self.func = func  # name of the function the tickerplant calls with each update
+        self.callbacks = {}  # table name, or None for every table -> callbacks
+        self.queue = collections.deque()  # [table, data, time received]
+        self.lock = threading.Condition()
+        self.closed = False
+        self.error = None  # exception that stopped the reader
+        self.received = 0
+        self.dispatched = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.blocked = 0.0  # seconds the reader waited for room in the queue
+        self.peak = 0
+        self.lag = 0.0  # seconds between receiving the last update dispatched and dispatching it
+        self.lag_max = 0.0
+        self.reader = None
+        self.dispatcher = None
+
+    def on(self, table, callback):
+        """call callback(table, data) with each update to table, or to every table when table is None"""
+        self.callbacks.setdefault(table, []).append(callback)
+
+    def subscribe(self, tables='', syms=''):
+        """subscribe with .u.sub and start the threads; returns the (table, schema) result of .u.sub"""
+        result = self.conn.k('.u.sub', [tables, syms])
+        if self.reader is None:
+            self.reader = threading.Thread(target=self._read)
+            self.dispatcher = threading.Thread(target=self._dispatch)
+            for t in (self.reader, self.dispatcher):
+                t.daemon = True
+                t.start()
+        return result
+
+    def _read(self):
+        try:
+            while not self.closed:
+                x = self.conn.kr()
+                if not isinstance(x, list) or len(x) != 3 or x[0] != self.func:
+                    continue
+                self._put(x[1], x[2])
+        except Exception as e:
+            if not self.closed:
+                self.error = e
+        with self.lock:
+            self.closed = True
+            self.lock.notify_all()
+
+    def _put(self, table, data):
+        now = time.time()
+        with self.lock:
+            self.received += 1
+            if len(self.queue) >= self.maxsize:
+                if self.policy == 'block':
+                    while len(self.queue) >= self.maxsize and not self.closed:
+                        self.lock.wait()
+                    self.blocked += time.time() - now
+                elif self.policy == 'coalesce' and self._coalesce(table, data):
+                    return
+                else:
+                    self.queue.popleft()
+                    self.dropped += 1
+            self.queue.append([table, data, now])
+            self.peak = max(self.peak, len(self.queue))
+            self.lock.notify_all()
+
+    def _coalesce(self, table, data):
+        for x in reversed(self.queue):
+            if x[0] == table:
+                joined = _join(x[1], data)
+                if joined is None:
+                    return False
+                x[1] = joined
+                self.coalesced += 1
+                return True
+        return False
+
+    def _dispatch(self):
+        log = logging.getLogger(__name__)
+        while True:
+            with self.lock:
+                while not self.queue and not self.closed:
+                    self.lock.wait()
+                if not self.queue:
+                    return
+                table, data, received = self.queue.popleft()
+                self.lock.notify_all()
+            for callback in self.callbacks.get(table, []) + self.callbacks.get(None, []):
+                try:
+                    callback(table, data)
+                except Exception:
+                    log.exception('subscriber callback failed for %s', table)
+            self.lag = time.time() - received
+            self.lag_max = max(self.lag_max, self.lag)
+            self.dispatched += 1
+
+    def stats(self):
+        """snapshot of the subscriber counters; lag and blocked are in seconds"""
+        with self.lock:
+            return {'depth': len(self.queue), 'peak': self.peak, 'maxsize': self.maxsize, 'policy': self.policy,
+                    'received': self.received, 'dispatched': self.dispatched, 'dropped': self.dropped,
+                    'coalesced': self.coalesced, 'blocked': self.blocked, 'lag': self.lag, 'lag_max': self.lag_max,
+                    'oldest': time.time() - self.queue[0][2] if self.queue else 0.0}
+
+    def close(self):
+        """close the connection and stop reading; updates already queued are still dispatched"""
+        with self.lock:
+            self.closed = True
+            self.lock.notify_all()
+        try:
+            # closing alone does not wake a thread blocked reading the socket
+            self.conn.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.conn.close()
+        if self.reader is not None:
+            self.reader.join()
+            self.dispatcher.join()
+
+
+def _join(x, y):
+    """the rows of the update y appended to those of x, for tables or lists of columns, or None"""
+    if isinstance(x, Flip) and isinstance(y, Flip):
+        if list(x.x) != list(y.x):
+            return None
+        return Flip(Dict(x.x, [_cat([a, b]) for a, b in zip(x.y, y.y)]))
+    if type(x) is list and type(y) is list and len(x) == len(y) and all(isinstance(c, (list, array.array)) or
+            (numpy is not None and isinstance(c, numpy.ndarray)) for c in x + y):
+        return [_cat([a, b]) for a, b in zip(x, y)]
+    return None
+
+
+class FanOut:
+    """Runs a query on several q processes at once, such as the partitions of an HDB or the shards of an RDB, on a
+    connection of its own to each target (host, port), and joins the tables they return.
+
+    query is one query for every target, or a list of one per target, each a query or a (query, args) pair.
+    timeout is the seconds each target has to answer, or a list of them; a target that does not answer in time
+    has its connection closed and counts as failed.  With processes set, responses are decoded in a pool of that
+    many processes rather than on the threads that read them, returned by pickling; numpy, temporal and symcodes
+    apply to the decoding as they do on q.  k returns a Gathered."""
+    def __init__(self, targets, user, timeout=None, processes=0):
+        self.targets = [tuple(t) for t in targets]
+        self.user = user
+        self.timeout = timeout
+        self.numpy = False
+        self.temporal = 'object'
+        self.symcodes = False
+        self.conns = {}  # connection to each target by its index in targets, made on first use and dropped when broken
+        self.lock = threading.Lock()  # one k at a time, the connections being used by its threads
+        self.threads = concurrent.futures.ThreadPoolExecutor(max(len(self.targets), 1))
+        self.processes = concurrent.futures.ProcessPoolExecutor(processes) if processes else None
+
+    def k(self, query, args=None, timeout=None):
+        """run query on every target and return the Gathered results"""
+        n = len(self.targets)
+        queries = query if isinstance(query, list) else [query] * n
+        if len(queries) != n:
+            raise Exception('%d queries for %d targets' % (len(queries), n))
+        queries = [x if isinstance(x, tuple) else (x, args) for x in queries]
+        timeout = self.timeout if timeout is None else timeout
+        timeouts = timeout if isinstance(timeout, list) else [timeout] * n
+        with self.lock:
+            start = time.time()
+            futures = [self.threads.submit(self._run, i, x, a, limit)
+                       for i, (x, a), limit in zip(range(n), queries, timeouts)]
+            results = []
+            for i, future, limit in zip(range(n), futures, timeouts):
+                try:
+                    results.append(future.result(None if limit is None else max(start + limit - time.time(), 0)))
+                except concurrent.futures.TimeoutError:
+                    # the thread is left to fail on the closed socket rather than waited for
+                    results.append((Exception('timeout'), limit))
+                    self._drop(i)
+                except Exception as e:
+                    results.append((e, time.time() - start))
+        return Gathered(self.targets, [r[0] for r in results], [r[1] for r in results])
+
+    def _run(self, i, query, args, timeout):
+        """run query on the target at i, returning its result and the seconds it took"""
+        start = time.time()
+        conn = self.conns.get(i)
+        try:
+            if conn is None:
+                # kept before connecting, so that a timeout can close it while it connects or logs in
+                host, port = self.targets[i]
+                conn = self.conns[i] = q(host, port, self.user, 0)
+                conn.CONNECT_TIMEOUT = timeout
+                conn.connect()
+            if self.processes is None:
+                conn.numpy, conn.temporal, conn.symcodes = self.numpy, self.temporal, self.symcodes
+                value = conn.k(query, args)
+            else:
+                conn._query(SYNC, query, args)
+                little_endian, zip, msgtype, size = conn._readHeader()
+                message = bytes(conn._readBody(size)[:size])
+                value = self.processes.submit(_decodeMessage, little_endian, zip, message, self.numpy, self.temporal,
+                                              self.symcodes).result()
+        except OSError:
+            self._drop(i, conn)
+            raise
+        except Exception:
+            # a q error or a decode error comes after the whole response; anything else leaves the connection unusable
+            if conn is not None and not conn.alive():
+                self._drop(i, conn)
+            raise
+        return value, time.time() - start
+
+    def _drop(self, i, conn=None):
+        """close the connection to the target at i, waking a thread blocked reading it.  Given conn, close that,
+        forgetting it only if it is still the one kept for i, as a timed out thread may fail after a new one is made"""
+        if conn is None:
+            conn = self.conns.pop(i, None)
+        elif self.conns.get(i) is conn:
+            del self.conns[i]
+        if conn is not None and conn.sock is not None:
+            try:
+                conn.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            conn.close()
+
+    def close(self):
+        with self.lock:
+            for i in list(self.conns):
+                self._drop(i)
+        self.threads.shutdown()
+        if self.processes is not None:
+            self.processes.shutdown()
+
+
+def _decodeMessage(little_endian, zip, message, numpy, temporal, symcodes):
+    """decode a response in a process of the pool of a FanOut"""
+    codec = q('localhost', 0, '', 0)  # no attempts: never connected
+    codec.numpy, codec.temporal, codec.symcodes = numpy, temporal, symcodes
+    return codec._decode(little_endian, zip, message)
+
+
+class Gathered:
+    """results of a FanOut query.  value is the tables returned joined into one, column by column in the order of
+    the targets, keyed tables included; when the results are not all tables with the same columns it is the list
+    of results instead.  results holds the result of each target, or the Exception it failed with, seconds the
+    time each took, and errors the Exceptions by target"""
+    def __init__(self, targets, results, seconds):
+        self.targets = targets
+        self.results = results
+        self.seconds = seconds
+        self.errors = {t: r for t, r in zip(targets, results) if isinstance(r, Exception)}
+        self.value = _merge([r for r in results if not isinstance(r, Exception)])
+
+    def result(self):
+        """value, raising an Exception naming the failed targets if any failed"""
+        if self.errors:
+            raise Exception('%d of %d targets failed: %s' % (len(self.errors), len(self.targets),
+                            ', '.join('%s:%s %s' % (t[0], t[1], e) for t, e in self.errors.items())))
+        return self.value
+
+
+def _merge(values):
+    """the tables in values joined into one, column by column, or values when they are not all alike tables"""
+    if values and all(isinstance(v, Flip) for v in values):
+        names = values[0].x
+        if all(v.x == names for v in values):
+            return Flip(Dict(names, [_cat([v.y[i] for v in values]) for i in range(len(names))]))
+    if values and all(isinstance(v, Dict) and isinstance(v.x, Flip) and isinstance(v.y, Flip) for v in values):
+        keys = _merge([v.x for v in values])
+        rows = _merge([v.y for v in values])
+        if isinstance(keys, Flip) and isinstance(rows, Flip):
+            return Dict(keys, rows)
+    return values
+
+
+class Offload:
+    """Decodes the responses of at least threshold bytes read by q.k in a pool of processes, so that decoding a
+    large result does not hold the GIL of the process that asked for it.  The message is received straight into a
+    shared memory block, and the worker leaves the vectors it decodes in shared memory: numeric and temporal vectors
+    in place in the message, byte swapped when need be, and the codes of symbol vectors in a block of its own.
+    Only the structure around them and the distinct symbols are pickled back, and the vectors are numpy arrays
+    over the shared memory, which is freed with the last of them.
+
+    Results decoded this way are as with q.numpy and q.symcodes set, temporal vectors being datetime64 and
+    timedelta64 unless q.temporal is 'raw'.  Set conn.offload = Offload() to use it; it may be shared by several
+    connections."""
+    def __init__(self, threshold=64*1024*1024, processes=2):
+        if numpy is None:
+            raise Exception('numpy is needed to decode off-process')
+        self.threshold = threshold  # bytes of the smallest message decoded off-process
+        self.pool = concurrent.futures.ProcessPoolExecutor(processes)
+
+    def decode(self, conn, little_endian, zip, size):
+        """receive the rest of the message of size bytes whose header conn has read, and decode it in the pool,
+        counting it in conn.decoded and conn.meter as q._readBody and q._decode do"""
+        meter = conn.meter
+        if meter is not None:
+            start = time.perf_counter()
+        block = _Block(create=True, size=size)
+        blocks = [block]
+        try:
+            view = block.buf
+            offset = 8
+            while offset < size:
+                n = conn.sock.recv_into(view[offset:size])
+                if n == 0:
+                    raise Exception('connection closed by host')
+                offset += n
+            # a compressed message holds its decompressed size after the header
+            conn.decoded = si[little_endian].unpack_from(view, 8)[0] if zip else size
+            del view
+            if meter is not None:
+                received = time.perf_counter()
+                meter.add('receive', received - start)
+                meter.received += 1
+                meter.wire_in += size
+                meter.decoded += conn.decoded
+            value, names = self.pool.submit(_offload, block.name, size, little_endian, zip, conn.columns).result()
+            blocks += [_Block(name) for name in names]
+            value = _attach(conn, value, {b.name: b for b in blocks})
+            if meter is not None:
+                meter.add('decode', time.perf_counter() - received)
+            return value
+        finally:
+            for b in blocks:
+                b.unlink()
+
+    def close(self):
+        self.pool.shutdown()
+
+
+class _Block(shared_memory.SharedMemory):
+    """shared memory whose mapping lives on as long as numpy arrays view it"""
+    def __del__(self):
+        try:
+            self.close()
+        except BufferError:
+            # still viewed: the mapping goes with the last array, only the descriptor can go now
+            if getattr(self, '_fd', -1) >= 0:
+                os.close(self._fd)
+                self._fd = -1
+
+
+class Shared:
+    """a vector left in the shared memory block name by a worker of an Offload, n items of dtype at offset, of q
+    type t; symbols are those of a symbol vector, whose codes are the items"""
+    def __init__(self, name, offset, dtype, n, t, symbols=None):
+        self.name = name
+        self.offset = offset
+        self.dtype = dtype
+        self.n = n
+        self.t = t
+        self.symbols = symbols
+    def __len__(self):
+        return self.n
+
+
+class _Offloaded(q):
+    """the decoder of an Offload worker, which decodes vectors to Shared references into the message"""
+    def _rv(self, t, n, little_endian, bytearray):
+        if t == 2 or t == 10:
+            return q._rv(self, t, n, little_endian, bytearray)
+        start = self.offset
+        self.offset += n * nt[t]
+        dtype = 'bool' if t == 1 else at[t]
+        if little_endian != LITTLE_ENDIAN:
+            numpy.frombuffer(bytearray, dtype, n, start).byteswap(inplace=True)
+        return Shared(self.block, start, dtype, n, t)
+
+    def _r(self, little_endian, bytearray, custom=True):
+        if bytearray[self.offset] == 98:
+            self.names = True  # the first symbol vector of a table is its column names, which stay a list
+        return q._r(self, little_endian, bytearray, custom)
+
+    def _syms(self, val):
+        if self.names:
+            self.names = False
+            return list(val)
+        index = {}
+        codes = numpy.array([index.setdefault(x, len(index)) for x in val], 'int32')
+        x = Shared(None, 0, 'int32', len(codes), 11, list(index))
+        self.codes.append((x, codes))
+        return x
+
+
+def _offload(name, size, little_endian, zip, columns):
+    """decode the message in the shared memory block name in a process of an Offload, returning it with Shared
+    references for its vectors, and the names of the blocks made for them"""
+    codec = _Offloaded('localhost', 0, '', 0)  # no attempts: never connected
+    codec.columns = columns
+    codec.names = False
+    codec.codes = []  # Shared symbol vectors and their codes, to be put in a block once all are known
+    block = _Block(name)
+    made = []
+    try:
+        buf = block.buf[:size]
+        if zip:
+            data = codec._u(little_endian, buf)
+            out = _Block(create=True, size=len(data))
+            made.append(out)
+            out.buf[:len(data)] = data
+            buf.release()
+            buf = out.buf[:len(data)]
+        codec.block = made[0].name if made else name
+        value = codec._decode(little_endian, False, buf)
+        buf.release()
+        if codec.codes:
+            out = _Block(create=True, size=sum(codes.nbytes for x, codes in codec.codes))
+            made.append(out)
+            offset = 0
+            for x, codes in codec.codes:
+                out.buf[offset:offset+codes.nbytes] = codes.tobytes()
+                x.name = out.name
+                x.offset = offset
+                offset += codes.nbytes
+        return value, [b.name for b in made]
+    except:
+        for b in made:
+            b.unlink()
+        raise
+
+
+def _attach(conn, x, blocks):
+    """x with its Shared references replaced by numpy arrays over the blocks they are in"""
+    if isinstance(x, Shared):
+        val = numpy.frombuffer(blocks[x.name].buf, x.dtype, x.n, x.offset)
+        if x.t == 11:
+            return Syms(val, list(map(conn.symcache.setdefault, x.symbols, x.symbols)))
+        if x.t > 11 and conn.temporal != 'raw':
+            return conn._tnp(x.t, val)
+        return val
+    if isinstance(x, list):
+        for i in range(len(x)):
+            x[i] = _attach(conn, x[i], blocks)
+    elif isinstance(x, Flip):
+        for i in range(len(x.cols)):
+            x.cols[i] = _attach(conn, x.cols[i], blocks)
+    elif isinstance(x, Dict):
+        x.x = _attach(conn, x.x, blocks)
+        x.y = _attach(conn, x.y, blocks)
+    return x
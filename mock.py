@@ -0,0 +1,273 @@
+"""
+A kdb+ stand in that speaks IPC well enough to run c.py against without a q process: it answers the login
+handshake of q.connect, then serves synchronous queries from canned responses or by echoing them back, in either
+byte order and optionally compressed.
+
+    from mock import Server
+    server = Server(responses={'instruments': c.Flip(c.Dict(['sym'], [['IBM', 'MSFT']])), 'f': lambda x: x + 1})
+    conn = c.q('127.0.0.1', server.port, 'user')
+    conn.k('instruments'); conn.k('f', [1])
+    server.close()
+
+Run on its own, python mock.py [port], it echoes until interrupted.
+"""
+
+import sys
+import socket
+import threading
+import array
+import struct
+import collections
+import c
+
+#array.array typecodes of the widths swapped between byte orders
+swt = { 2: 'h', 4: 'i', 8: 'q' }
+
+def swap(buf, little_endian, offset=0):
+    """reverse the byte order of the fixed width fields of the IPC object at offset in the bytearray buf, in place,
+    from little endian when little_endian is set, and return the offset just past it"""
+    t = struct.unpack_from('b', buf, offset)[0]
+    offset += 1
+    if t < 0:
+        if t == -11 or t == -128:
+            return buf.index(0, offset) + 1
+        w = 16 if t == -2 else c.nt[-t] if t > -20 else 4
+        return offset + w if w not in swt else _swapv(buf, offset, w, 1)
+    if t < 98 and t != 77:
+        n = _swapn(buf, little_endian, offset + 1)  # after the attributes
+        offset += 5
+        if t == 0:
+            for i in range(n):
+                offset = swap(buf, little_endian, offset)
+            return offset
+        if t == 11:
+            for i in range(n):
+                offset = buf.index(0, offset) + 1
+            return offset
+        w = 16 if t == 2 else c.nt[t] if t < 20 else 4
+        return offset + w * n if w not in swt else _swapv(buf, offset, w, n)
+    if t == 98:
+        return swap(buf, little_endian, offset + 1)
+    if t == 99 or t == 127:
+        return swap(buf, little_endian, swap(buf, little_endian, offset))
+    if t == 100:
+        return swap(buf, little_endian, buf.index(0, offset) + 1)
+    if 100 < t < 104:
+        return offset + 1
+    if t == 104 or t == 105:
+        n = _swapn(buf, little_endian, offset)
+        offset += 4
+        for i in range(n):
+            offset = swap(buf, little_endian, offset)
+        return offset
+    if 105 < t < 112:
+        return swap(buf, little_endian, offset)
+    if t == 128:
+        return buf.index(0, offset) + 1
+    raise Exception('unsupported type %d' % t)
+
+def _swapn(buf, little_endian, offset):
+    """swap the length at offset and return it, as read in the original byte order"""
+    n = struct.unpack_from('<i' if little_endian else '>i', buf, offset)[0]
+    _swapv(buf, offset, 4, 1)
+    return n
+
+def _swapv(buf, offset, w, n):
+    end = offset + w * n
+    a = array.array(swt[w], buf[offset:end])
+    a.byteswap()
+    buf[offset:end] = a.tobytes()
+    return end
+
+class Server:
+    """kdb+ stand in serving each connection on a thread of its own.  A synchronous query gets the value that
+    responses holds for its text, called with the query's arguments when it is callable, or the message itself
+    when responses has nothing for it.  An Exception, returned or raised, goes back as a q error, as does a value
+    that cannot be encoded.  Asynchronous messages are kept in messages, decoded, or as the Exception decoding
+    them raised, and a callable response for their text is called with their arguments, its result discarded.
+    Replies are little endian unless little_endian is False, and those longer than COMPRESS_THRESHOLD bytes are
+    compressed when compress is set."""
+    COMPRESS_THRESHOLD = 2000
+    def __init__(self, port=0, host='127.0.0.1', responses=None, little_endian=True, compress=False,
+                 capability=3, users=None):
+        self.responses = responses if responses is not None else {}
+        self.little_endian = little_endian
+        self.compress = compress
+        self.capability = capability  # sent back on login, 0 plays a server that drops clients sending one
+        self.users = users  # password of each user allowed in, None lets everyone in
+        self.messages = collections.deque()  # asynchronous messages received, decoded
+        self.logins = 0
+        self.codec = c.q(host, port, '', 0)  # no attempts: a q that is never connected, for its encoder and decoder
+        self.codec.remote_ver = 3
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((host, port))
+        self.sock.listen(64)
+        self.port = self.sock.getsockname()[1]
+        self.clients = []
+        self.lock = threading.Lock()  # the codec is shared by every connection
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    def close(self):
+        self.sock.close()
+        for conn in self.clients:
+            try:
+                conn.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            conn.close()
+
+    def __enter__(self):
+        return self
+    def __exit__(self, *exc):
+        self.close()
+
+    def _accept(self):
+        while True:
+            try:
+                conn, addr = self.sock.accept()
+            except OSError:
+                return
+            self.clients.append(conn)
+            threading.Thread(target=self._serve, args=(conn,), daemon=True).start()
+
+    def _serve(self, conn):
+        try:
+            if not self._login(conn):
+                conn.close()
+                return
+            while True:
+                header = self._recv(conn, 8)
+                little_endian = header[0] == 1
+                size = struct.unpack('<i' if little_endian else '>i', header[4:])[0]
+                message = header + self._recv(conn, size - 8)
+                if header[2] == 1:
+                    with self.lock:
+                        message = bytearray(self.codec._u(little_endian, message))
+                if header[1] == 1:
+                    try:
+                        response = self._respond(little_endian, message)
+                    except Exception as e:
+                        # a response that cannot be encoded goes back as an error rather than leave the client waiting
+                        response = self.frame(self._error(e))
+                    conn.sendall(response)
+                else:
+                    self._apply(little_endian, message)
+        except (EOFError, OSError):
+            conn.close()
+
+    def _login(self, conn):
+        """read the credentials, user:password then an optional capability byte, and answer them"""
+        login = b''
+        while not login.endswith(b'\0'):
+            login += self._recv(conn, 1)
+        login = login[:-1]
+        capability = None
+        if login and login[-1] < 32:
+            capability = login[-1]
+            login = login[:-1]
+        user, _, password = login.decode('latin-1').partition(':')
+        if self.users is not None and self.users.get(user) != password:
+            return False
+        if capability is not None and self.capability == 0:
+            return False
+        conn.sendall(bytes([min(self.capability, 3 if capability is None else capability)]))
+        self.logins += 1
+        return True
+
+    def _respond(self, little_endian, message):
+        """the response to the synchronous query message"""
+        query = None  # echoed back
+        if self.responses:
+            try:
+                with self.lock:
+                    query = self.codec._decode(little_endian, False, message)
+            except Exception:
+                pass
+        if isinstance(query, list) and query and isinstance(query[0], str):
+            text, args = query[0], query[1:]
+        else:
+            text, args = query, []
+        value = self.responses.get(text) if isinstance(text, str) else None
+        if value is None:
+            body = bytearray(message[8:])
+            if little_endian != self.little_endian:
+                swap(body, little_endian)
+        else:
+            try:
+                if callable(value):
+                    value = value(*args)
+            except Exception as e:
+                value = e
+            if isinstance(value, Exception):
+                body = self._error(value)
+            else:
+                with self.lock:
+                    body = self.codec._encode(False, value)[8:]
+                if self.little_endian:
+                    swap(body, False)
+        return self.frame(body)
+
+    def _apply(self, little_endian, message):
+        """keep the asynchronous message, decoded, and call the response for its text when that is callable, as q
+        evaluates it, ignoring what it returns or raises"""
+        try:
+            with self.lock:
+                query = self.codec._decode(little_endian, False, message)
+        except Exception as e:
+            query = e
+        self.messages.append(query)
+        if isinstance(query, list) and query and isinstance(query[0], str):
+            value = self.responses.get(query[0])
+            if callable(value):
+                try:
+                    value(*query[1:])
+                except Exception:
+                    pass
+
+    def _error(self, e):
+        """the body of a q error carrying the text of e"""
+        return bytearray(b'\x80' + str(e).encode('latin-1', 'replace') + b'\0')
+
+    def frame(self, body):
+        """the response message carrying the encoded body, in the server's byte order"""
+        order = '<i' if self.little_endian else '>i'
+        message = bytearray([1 if self.little_endian else 0, 2, 0, 0]) + struct.pack(order, 8 + len(body)) + body
+        if self.compress and len(message) > self.COMPRESS_THRESHOLD:
+            with self.lock:
+                message = self.codec._z(message)
+            if message[2] == 1:
+                # _z writes both lengths big endian
+                message[4:12] = struct.pack(order + order[1], *struct.unpack('>ii', message[4:12]))
+        return bytes(message)
+
+    def publish(self, value):
+        """send value as an asynchronous message to every connection, as a tickerplant does"""
+        with self.lock:
+            body = self.codec._encode(False, value)[8:]
+        if self.little_endian:
+            swap(body, False)
+        message = bytearray(self.frame(body))
+        message[1] = 0
+        for conn in list(self.clients):
+            try:
+                conn.sendall(message)
+            except OSError:
+                pass
+
+    def _recv(self, conn, n):
+        data = b''
+        while len(data) < n:
+            chunk = conn.recv(n - len(data))
+            if not chunk:
+                raise EOFError
+            data += chunk
+        return data
+
+if __name__ == '__main__':
+    server = Server(int(sys.argv[1]) if len(sys.argv) > 1 else 5001, '0.0.0.0')
+    print('listening on', server.port)
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.close()
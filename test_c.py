@@ -0,0 +1,497 @@
+"""
+Tests of c.py against mock.Server, run with python -m pytest.
+"""
+
+import array
+import asyncio
+import datetime
+import socket
+import threading
+import time
+from uuid import UUID
+import pytest
+import c
+import mock
+
+def plain(x):
+    """x with the containers the decoder may choose made into lists, for comparing"""
+    if isinstance(x, c.Flip):
+        return ('flip', [str(n) for n in x.x], [plain(v) for v in x.y])
+    if isinstance(x, c.Dict):
+        return ('dict', plain(x.x), plain(x.y))
+    if isinstance(x, (c.Month, c.Minute, c.Second)):
+        return (type(x).__name__, x.i)
+    if isinstance(x, (bytes, bytearray)):
+        return x.decode('latin-1')
+    if isinstance(x, (list, tuple, array.array, c.Syms)):
+        return [plain(v) for v in x]
+    if hasattr(x, 'tolist'):
+        return plain(x.tolist())
+    return x
+
+stamp = c.timestamp(2020, 1, 2, 3, 4, 5)
+atoms = [('boolean', True), ('guid', UUID(int=12345)), ('long', 2**40), ('float', 1.5),
+         ('symbol', 'IBM'), ('timestamp', stamp), ('month', c.Month(240)), ('date', datetime.date(2020, 1, 2)),
+         ('datetime', datetime.datetime(2020, 1, 2, 3, 4, 5)), ('timespan', datetime.timedelta(seconds=5)),
+         ('minute', c.Minute(90)), ('second', c.Second(5400)), ('time', datetime.time(1, 2, 3))]
+if c.numpy is not None:
+    # the atom types no Python type is encoded as
+    atoms += [('byte', c.numpy.int8(-5)), ('short', c.numpy.int16(300)), ('int', c.numpy.int32(5)),
+              ('real', c.numpy.float32(1.5)), ('float', c.numpy.float64(2.5)), ('char', c.numpy.bytes_(b'x'))]
+
+def vectors(n):
+    return [('boolean', [i % 2 == 0 for i in range(n)]), ('guid', [UUID(int=i) for i in range(n)]),
+            ('byte', array.array('b', [i % 100 for i in range(n)])),
+            ('short', array.array('h', [i % 30000 for i in range(n)])), ('int', array.array('i', range(n))),
+            ('long', [2**40 + i for i in range(n)]), ('real', array.array('f', [i / 2 for i in range(n)])),
+            ('float', array.array('d', [i / 2 for i in range(n)])), ('char', b'x' * n),
+            ('symbol', ['S%d' % (i % 10) for i in range(n)]),
+            ('timestamp', [stamp + datetime.timedelta(seconds=i) for i in range(n)]),
+            ('month', [c.Month(i % 1000) for i in range(n)]),
+            ('date', [datetime.date(2020, 1, 2) + datetime.timedelta(days=i) for i in range(n)]),
+            ('datetime', [datetime.datetime(2020, 1, 2) + datetime.timedelta(seconds=i) for i in range(n)]),
+            ('timespan', [datetime.timedelta(microseconds=i) for i in range(n)]),
+            ('minute', [c.Minute(i % 1440) for i in range(n)]), ('second', [c.Second(i % 86400) for i in range(n)]),
+            ('time', [datetime.time(i % 24, i % 60) for i in range(n)])]
+
+def trade(n):
+    return c.Flip(c.Dict(['sym', 'px', 'qty'], [['S%d' % (i % 10) for i in range(n)],
+                                                array.array('d', [i / 4 for i in range(n)]),
+                                                array.array('i', range(n))]))
+
+def keyed(n):
+    return c.Dict(c.Flip(c.Dict(['sym'], [['S%d' % i for i in range(n)]])),
+                  c.Flip(c.Dict(['px', 'qty'], [array.array('d', [i / 4 for i in range(n)]), array.array('i', range(n))])))
+
+@pytest.fixture
+def server():
+    s = mock.Server(responses={'trade': trade(1000), 'keyed': keyed(3), 'add': lambda x, y: x + y,
+                               'err': Exception('nope'), 'none': lambda: None})
+    yield s
+    s.close()
+
+@pytest.fixture
+def conn(server):
+    conn = c.q('127.0.0.1', server.port, 'user')
+    yield conn
+    conn.close()
+
+@pytest.mark.parametrize('little_endian', [True, False])
+@pytest.mark.parametrize('compress', [False, True])
+def test_round_trip(little_endian, compress):
+    s = mock.Server(little_endian=little_endian, compress=compress)
+    conn = c.q('127.0.0.1', s.port, 'user')
+    conn.localhost = False
+    conn.compress = compress
+    try:
+        for name, x in atoms + vectors(1000) + [('table', trade(1000)), ('keyed table', keyed(1000)),
+                                                 ('list', [1, 'a', [1.5, 2.5], b'ab'])]:
+            r = conn.k('echo', [x])
+            assert r[0] == 'echo' and plain(r[1]) == plain(x), name
+    finally:
+        conn.close()
+        s.close()
+
+def test_every_vector_type_is_covered():
+    kinds = {'boolean': 1, 'guid': 2, 'byte': 4, 'short': 5, 'int': 6, 'long': 7, 'real': 8, 'float': 9, 'char': 10,
+             'symbol': 11, 'timestamp': 12, 'month': 13, 'date': 14, 'datetime': 15, 'timespan': 16, 'minute': 17,
+             'second': 18, 'time': 19}
+    codec = c.q('localhost', 0, '', 0)
+    codec.remote_ver = 3
+    for name, x in vectors(3):
+        assert codec._qtype(x) == kinds[name], name
+    for name, x in atoms:
+        assert codec._qtype(x) == -kinds[name], name
+    assert {t for t in range(len(c.nt)) if c.nt[t]} | {11} <= set(kinds.values())
+    if c.numpy is not None:
+        assert {name for name, x in atoms} == set(kinds)
+
+def test_python_types():
+    codec = c.q('localhost', 0, '', 0)
+    codec.remote_ver = 3
+    # ints are longs and floats are floats whatever their values; arrays choose other widths
+    assert [codec._qtype(x) for x in (1, 2**40, 1.5, [1, 2], [2**40], [100.1, 2.5])] == [-7, -7, -9, 7, 7, 9]
+    assert codec._qtype(array.array('i', [1])) == 6 and codec._qtype(array.array('f', [1])) == 8
+    assert plain(codec._decode(False, False, codec._encode(False, [100.1, 2.5]))) == [100.1, 2.5]
+
+# kdb+ IPC messages as c.py sends them: the header, big endian, async, then the type, attributes, length and items
+layouts = [
+    ('boolean', [True, False], '00000000000000100100000000020100'),
+    ('guid', [UUID(int=1)], '000000000000001e02000000000100000000000000000000000000000001'),
+    ('byte', array.array('b', [1, -2]), '000000000000001004000000000201fe'),
+    ('short', array.array('h', [1, -2]), '00000000000000120500000000020001fffe'),
+    ('int', array.array('i', [1, -2]), '000000000000001606000000000200000001fffffffe'),
+    ('long', [1, -2], '000000000000001e0700000000020000000000000001fffffffffffffffe'),
+    ('real', array.array('f', [1.5]), '00000000000000120800000000013fc00000'),
+    ('float', [1.5], '00000000000000160900000000013ff8000000000000'),
+    ('char', b'ab', '00000000000000100a00000000026162'),
+    ('symbol', ['ab', 'c'], '00000000000000130b00000000026162006300'),
+    ('timestamp', [c.timestamp(2000, 1, 1, 0, 0, 1)], '00000000000000160c0000000001000000003b9aca00'),
+    ('month', [c.Month(13)], '00000000000000120d00000000010000000d'),
+    ('date', [datetime.date(2000, 1, 3)], '00000000000000120e000000000100000002'),
+    ('datetime', [datetime.datetime(2000, 1, 2, 12)], '00000000000000160f00000000013ff8000000000000'),
+    ('timespan', [datetime.timedelta(seconds=1)], '0000000000000016100000000001000000003b9aca00'),
+    ('minute', [c.Minute(3)], '000000000000001211000000000100000003'),
+    ('second', [c.Second(3)], '000000000000001212000000000100000003'),
+    ('time', [datetime.time(0, 0, 1)], '0000000000000012130000000001000003e8'),
+    ('dict', c.Dict(['a'], [1]), '000000000000001f630b000000000161000700000000010000000000000001'),
+    ('table', c.Flip(c.Dict(['a'], [[1]])), '00000000000000276200630b000000000161000000000000010700000000010000000000000001'),
+]
+
+@pytest.mark.parametrize('name,x,layout', layouts, ids=[name for name, x, layout in layouts])
+def test_layout(name, x, layout):
+    if name == 'datetime' and time.localtime(time.mktime(x[0].timetuple())).tm_isdst > 0:
+        pytest.skip('datetimes are encoded from local standard time, which is off in summer time')
+    codec = c.q('localhost', 0, '', 0)
+    codec.remote_ver = 3
+    assert bytes(codec._encode(False, x)).hex() == layout
+    assert plain(codec._decode(False, False, bytes.fromhex(layout))) == plain(x)
+
+def test_layouts_cover_nt():
+    types = {bytes.fromhex(layout)[8] for name, x, layout in layouts}
+    assert {t for t in range(len(c.nt)) if c.nt[t]} | {11, 98, 99} <= types
+
+def test_responses(conn):
+    assert conn.k('add', [2, 3]) == 5
+    with pytest.raises(Exception, match='nope'):
+        conn.k('err')
+    with pytest.raises(Exception):
+        conn.k('none')  # cannot be encoded, answered with an error
+    assert conn.k('add', [1, 1]) == 2
+
+def test_async(server, conn):
+    conn.ks('upd', ['t', [1, 2]])
+    conn.k('add', [0, 0])
+    assert plain(server.messages.popleft()) == ['upd', 't', [1, 2]]
+    server.publish(['upd', 'trade', [1]])
+    assert plain(conn.kr()) == ['upd', 'trade', [1]]
+
+def test_lazy(conn):
+    conn.lazy = True
+    t = conn.k('trade')
+    assert t.cols == [None, None, None]
+    assert plain(t['px']) == plain(trade(1000)['px'])
+    assert t.cols[0] is None and t.cols[1] is not None
+    assert plain(t) == plain(trade(1000))
+
+@pytest.mark.parametrize('lazy', [False, True])
+@pytest.mark.parametrize('symcodes', [False, True])
+def test_columns(conn, lazy, symcodes):
+    conn.lazy = lazy
+    conn.symcodes = symcodes
+    t = conn.k('trade', columns=['qty', 'sym', 'nope'])
+    assert list(t.x) == ['qty', 'sym'] and plain(t['qty']) == list(range(1000))
+    assert plain(t['sym'])[:2] == ['S0', 'S1']
+    kt = conn.k('keyed', columns=['qty'])
+    assert list(kt.x.x) == ['sym'] and list(kt.y.x) == ['qty'] and len(kt.x) == len(kt.y) == 3
+    assert plain(kt['S2']) == [2]
+    assert conn.columns is None
+
+@pytest.mark.parametrize('temporal', ['object', 'raw', 'numpy'])
+@pytest.mark.parametrize('numpy', [False, True])
+def test_to_pandas(temporal, numpy):
+    pandas = pytest.importorskip('pandas')
+    codec = c.q('localhost', 0, '', 0)
+    codec.remote_ver = 3
+    nulls = [('null timestamp', pandas.to_datetime(['2020-01-02', None]).to_numpy()),
+             ('null timespan', pandas.to_timedelta([1000, None]).to_numpy())]
+    names = [name for name, x in vectors(2) + nulls]
+    message = bytes(codec._encode(False, c.Flip(c.Dict(names, [x for name, x in vectors(2) + nulls]))))
+    frames = []
+    for lazy in (False, True):
+        codec.temporal, codec.numpy, codec.lazy = temporal, numpy, lazy
+        frames.append(codec._decode(False, False, message).to_pandas())
+    eager, lazy = frames
+    for name in names:
+        assert eager[name].dtype == lazy[name].dtype and eager[name].tolist() == lazy[name].tolist(), name
+    assert eager['boolean'].dtype == bool and eager['timestamp'].dtype == 'datetime64[ns]'
+    assert eager['date'].tolist() == [pandas.Timestamp(2020, 1, 2 + i) for i in range(2)]
+    assert eager['null timestamp'].isna().tolist() == eager['null timespan'].isna().tolist() == [False, True]
+    kt = codec._decode(False, False, bytes(codec._encode(False, keyed(3)))).to_pandas()
+    assert kt.index.name == 'sym' and kt.loc['S2', 'qty'] == 2
+
+def test_frame(conn):
+    pandas = pytest.importorskip('pandas')
+    frame = pandas.DataFrame({'sym': pandas.Categorical(['a', 'b', 'a']), 'px': [1.5, 2.5, None],
+                              'qty': pandas.array([1, None, 3], 'Int32'), 'ok': [True, False, True],
+                              'at': pandas.to_datetime(['2020-01-02', '2020-01-03', '2020-01-04'])})
+    t = conn.k('echo', [frame])[1]
+    assert list(t.x) == ['sym', 'px', 'qty', 'ok', 'at']
+    assert plain(t['sym']) == ['a', 'b', 'a'] and plain(t['ok']) == [True, False, True]
+    assert plain(t['qty']) == [1, -2**31, 3] and plain(t['px'])[:2] == [1.5, 2.5]
+    back = t.to_pandas()
+    assert back['at'].tolist() == frame['at'].tolist() and back['ok'].dtype == bool
+    keyed = conn.k('echo', [frame.set_index('sym')])[1]
+    assert list(keyed.x.x) == ['sym'] and plain(keyed.x['sym']) == ['a', 'b', 'a']
+    assert keyed.to_pandas().index.name == 'sym'
+
+def test_stream(conn):
+    pieces = list(conn.k_stream('trade', rows=300))
+    assert [name for name, values in pieces] == ['sym'] * 4 + ['px'] * 4 + ['qty'] * 4
+    assert sum((plain(v) for name, v in pieces if name == 'qty'), []) == list(range(1000))
+    assert list(conn.k_stream('add', [1, 2])) == [(None, 3)]
+
+def test_pipelined(conn):
+    ps = [conn.kp('add', [i, 1]) for i in range(5)]
+    assert conn.k('add', [10, 10]) == 20
+    assert [p.result() for p in ps] == [1, 2, 3, 4, 5]
+    results = conn.k_many([('add', [1, 2]), 'err', ('add', [3, 4])])
+    assert results[0] == 3 and isinstance(results[1], Exception) and results[2] == 7
+
+def test_prepared(conn):
+    add = conn.prepare('add')
+    assert add(1, 2) == 3 and add.kp(3, 4).result() == 7
+
+def test_cache(conn):
+    sent = []
+    send = conn._send
+    conn._send = lambda *a: sent.append(1) or send(*a)
+    conn.cache = c.Cache(ttl=10)
+    for i in range(3):
+        assert conn.k('add', [1, 2], cache=True) == 3
+    assert len(sent) == 1 and conn.cache.stats()['hits'] == 2
+    conn.k('add', [1, 2])
+    conn.k('add', [1, 2])
+    assert len(sent) == 3  # only the calls asking for it are cached
+    conn.k('add', [2, 2], cache=True)
+    assert len(sent) == 4
+    with pytest.raises(Exception):
+        conn.k('err', cache=True)
+    with pytest.raises(Exception):
+        conn.k('err', cache=True)
+    assert len(sent) == 6
+    conn.cache.invalidate('add')
+    conn.k('add', [1, 2], cache=True)
+    assert len(sent) == 7
+    conn.lazy = True
+    assert conn.k('trade', cache=True).reader is None
+    kt = conn.k('keyed', cache=True)
+    assert kt.x.reader is None and kt.y.reader is None and plain(kt) == plain(keyed(3))
+    assert conn.k('trade').reader is not None  # not cached, so left to decode on first use
+
+def test_pool(server):
+    pool = c.QPool('127.0.0.1', server.port, 'user', size=2, ping_after=0, cache=c.Cache())
+    try:
+        with pool.connection() as a, pool.connection() as b:
+            assert a is not b
+            with pytest.raises(Exception, match='timed out'):
+                pool.checkout(0.1)
+        assert pool.k('add', [1, 2], cache=True) == 3 and pool.k('add', [1, 2], cache=True) == 3
+        assert pool.cache.stats()['hits'] == 1
+        for i in range(3):
+            with pool.connection():
+                pass  # each checkout pings, never from the cache
+        assert pool.cache.stats()['hits'] == 1
+        stats = pool.stats()
+        assert stats['live'] == 2 and stats['timeouts'] == 1 and stats['failures'] == 0
+    finally:
+        pool.close()
+    with pytest.raises(Exception, match='pool closed'):
+        pool.checkout()
+
+def test_pool_deadline():
+    mute = socket.socket()  # accepts connections but never answers the login
+    mute.bind(('127.0.0.1', 0))
+    mute.listen(4)
+    dead = socket.socket()
+    dead.bind(('127.0.0.1', 0))  # bound, not listening: connections are refused
+    try:
+        for port in (mute.getsockname()[1], dead.getsockname()[1]):
+            pool = c.QPool('127.0.0.1', port, 'user', size=1)
+            start = time.time()
+            with pytest.raises(Exception, match='unable to connect'):
+                pool.checkout(0.3)
+            assert time.time() - start < 1 and pool.stats()['live'] == 0
+    finally:
+        mute.close()
+        dead.close()
+
+def test_asyncq(server):
+    async def run():
+        conn = await c.AsyncQ.open('127.0.0.1', server.port, 'user')
+        try:
+            results = await asyncio.gather(*[conn.k('add', [i, 1]) for i in range(5)])
+            for f in (conn.kp, conn.k_many, conn.k_stream, conn.upload):
+                with pytest.raises(Exception, match='not available on AsyncQ'):
+                    f('add', [1, 2])
+            add = conn.prepare('add')
+            await add.ks(1, 2)
+            return results, await add(3, 4), await conn.k('add', [5, 6])
+        finally:
+            conn.close()
+    assert asyncio.run(run()) == ([1, 2, 3, 4, 5], 7, 11)
+    assert plain(server.messages.popleft()) == ['add', 1, 2]
+
+def test_publisher(server, conn):
+    numpy = pytest.importorskip('numpy')
+    p = c.Publisher(conn, rows=3, latency=None)
+    p.bulk('trade', [['A', 'B'], array.array('f', [1.0, 2.0]), array.array('i', [1, 2])])
+    p.upd('trade', ['C', 3.0, 3])  # the third row sends the table
+    p.bulk('quote', [['A'], numpy.array([1.5])])
+    p.upd('quote', ['B', 2.5])
+    p.sync()
+    trade, quote = server.messages.popleft(), server.messages.popleft()
+    assert trade[:2] == ['.u.upd', 'trade'] and trade[2][0] == ['A', 'B', 'C']
+    # the rows of upd take the types of the chunks given to bulk
+    assert [(x.typecode, list(x)) for x in trade[2][1:]] == [('f', [1.0, 2.0, 3.0]), ('i', [1, 2, 3])]
+    assert quote[:2] == ['.u.upd', 'quote'] and quote[2][1].typecode == 'd' and list(quote[2][1]) == [1.5, 2.5]
+    assert p.messages == 2 and p.published == 5 and not server.messages
+    p.close()
+    with pytest.raises(Exception, match='publisher closed'):
+        p.bulk('trade', [['A'], [1.0]])
+
+def test_publisher_timer(server, conn):
+    p = c.Publisher(conn, latency=0.05)
+    try:
+        p.upd('trade', ['A', 1.0])
+        for i in range(100):
+            if server.messages:
+                break
+            time.sleep(0.01)
+        assert plain(server.messages.popleft()) == ['.u.upd', 'trade', [['A'], [1.0]]]
+    finally:
+        p.close()
+
+def until(f, timeout=5):
+    """wait for f() to be true"""
+    end = time.time() + timeout
+    while not f():
+        assert time.time() < end, 'timed out'
+        time.sleep(0.005)
+
+@pytest.mark.parametrize('policy', ['block', 'drop', 'coalesce'])
+def test_subscriber(server, conn, policy):
+    server.responses['.u.sub'] = lambda tables, syms: ['trade', trade(0)]
+    sub = c.Subscriber(conn, maxsize=2, policy=policy)
+    gate = threading.Event()
+    got = []
+    def held(table, data):
+        got.append(plain(data))
+        gate.wait()
+    sub.on('trade', held)
+    assert sub.subscribe('trade')[0] == 'trade'
+    server.publish(['upd', 'trade', [[0]]])
+    until(lambda: got)  # the dispatcher holds the first update
+    for i in range(1, 5):
+        server.publish(['upd', 'trade', [[i]]])
+    until(lambda: sub.stats()['received'] == (4 if policy == 'block' else 5))
+    stats = sub.stats()
+    assert stats['depth'] == 2 and stats['peak'] == 2 and stats['policy'] == policy
+    gate.set()
+    until(lambda: sub.stats()['received'] == 5 and sub.stats()['depth'] == 0)
+    until(lambda: sub.stats()['dispatched'] == len(got))
+    stats = sub.stats()
+    if policy == 'block':
+        assert got == [[[i]] for i in range(5)] and stats['blocked'] > 0 and stats['dropped'] == 0
+    elif policy == 'drop':
+        assert got == [[[0]], [[3]], [[4]]] and stats['dropped'] == 2
+    else:
+        assert got == [[[0]], [[1]], [[2, 3, 4]]] and stats['coalesced'] == 2 and stats['dropped'] == 0
+    assert stats['lag_max'] >= stats['lag'] >= 0
+    sub.close()
+
+def test_subscriber_close(server, conn):
+    server.responses['.u.sub'] = lambda tables, syms: ['trade', trade(0)]
+    sub = c.Subscriber(conn)
+    sub.subscribe()
+    start = time.time()
+    sub.close()  # the reader is blocked reading the socket
+    assert time.time() - start < 1 and not sub.reader.is_alive() and not sub.dispatcher.is_alive()
+    assert sub.error is None
+
+def test_login():
+    s = mock.Server(users={'user': 'pass'})
+    try:
+        assert c.q('127.0.0.1', s.port, 'user:pass').remote_ver == 3
+        with pytest.raises(Exception, match='access denied'):
+            c.q('127.0.0.1', s.port, 'user:wrong')
+    finally:
+        s.close()
+
+def test_fanout(server):
+    mute = socket.socket()  # accepts connections but never answers the login
+    mute.bind(('127.0.0.1', 0))
+    mute.listen(4)
+    f = c.FanOut([('127.0.0.1', server.port), ('127.0.0.1', server.port)], 'user')
+    g = c.FanOut([('127.0.0.1', server.port), mute.getsockname()], 'user', timeout=0.3)
+    try:
+        assert len(f.k('trade').value) == 2000
+        start = time.time()
+        r = g.k('add', [1, 2])
+        assert time.time() - start < 1 and r.results[0] == 3 and str(r.results[1]) == 'timeout'
+    finally:
+        f.close()
+        g.close()
+        mute.close()
+
+def test_offload(conn):
+    pytest.importorskip('numpy')
+    conn.k('trade')
+    size = conn.decoded
+    conn.meter = c.Meter()
+    conn.cache = c.Cache(size=size - 1)
+    conn.offload = c.Offload(threshold=100, processes=1)
+    try:
+        t = conn.k('trade', cache=True)
+        assert list(t['sym'][:2]) == ['S0', 'S1'] and list(t['qty']) == list(range(1000))
+    finally:
+        conn.offload.close()
+    stats = conn.meter.stats()
+    assert conn.decoded == size and stats['received'] == 1 and stats['decoded'] == size
+    assert stats['seconds']['receive'] > 0 and stats['seconds']['decode'] > 0
+    assert conn.cache.stats()['entries'] == 0  # counted at its full size, past the budget
+
+class Tables:
+    """the side of q that upload relies on: func applied to chunks, errors of asynchronous ones kept to be raised,
+    by client, each served on its own thread of the mock.Server as .z.w"""
+    def __init__(self):
+        self.rows = {}
+        self.failed = {}
+        self.responses = {c.q.UPLOAD_APPLY: self.apply, c.q.UPLOAD_CHECK: self.check, c.q.UPLOAD_CLEAR: self.clear}
+    def insert(self, f, t, x):
+        if f != 'insert' or any(v < 0 for v in x['qty']):
+            raise Exception('type')
+        self.rows[t] = self.rows.get(t, 0) + len(x)
+        return len(x)
+    def apply(self, f, t, x):
+        try:
+            self.insert(f, t, x)
+        except Exception as e:
+            self.failed.setdefault(threading.get_ident(), []).append(str(e))
+    def check(self, f, t, x):
+        e = self.failed.pop(threading.get_ident(), [])
+        if e:
+            raise Exception('upload: %d chunks failed, the first with %s' % (len(e), e[0]))
+        return self.insert(f, t, x)
+    def clear(self):
+        self.failed.pop(threading.get_ident(), None)
+
+def test_upload():
+    tables = Tables()
+    s = mock.Server(responses=tables.responses)
+    conn = c.q('127.0.0.1', s.port, 'user')
+    try:
+        t = trade(10000)
+        assert conn.upload('trade', t, size=20000, inflight=2) == 10000
+        assert tables.rows['trade'] == 10000 and len(s.messages) > 3 and not conn.pending
+        assert conn.upload('dict', {'qty': [1, 2, 3]}) == 3 and tables.rows['dict'] == 3
+        assert conn.upload('empty', {'qty': []}) == 0 and tables.rows['empty'] == 0
+        t['qty'][0] = -1  # fails in the first chunk, sent asynchronously
+        with pytest.raises(Exception, match='upload: 1 chunks failed, the first with type'):
+            conn.upload('bad', t, size=20000, inflight=2)
+        assert not conn.pending and conn.upload('dict', {'qty': [4]}) == 1 and tables.rows['dict'] == 4
+        t['qty'][5000:] = array.array('i', [-1] * 5000)  # fails in a synchronous chunk, and the ones sent after it
+        with pytest.raises(Exception, match='type'):
+            conn.upload('bad', t, size=20000, inflight=6)
+        assert conn.upload('dict', {'qty': [5]}) == 1 and not tables.failed
+        # errors are kept by client: one left by another connection is not raised here
+        other = c.q('127.0.0.1', s.port, 'user')
+        other.ks(c.q.UPLOAD_APPLY, [b'insert', 'bad', c.Flip(c.Dict(['qty'], [[-1]]))])
+        other.k('sync')
+        assert conn.upload('dict', {'qty': [6]}) == 1
+        with pytest.raises(Exception, match='upload: 1 chunks failed'):
+            other.upload('dict', {'qty': [7]})
+        other.close()
+    finally:
+        conn.close()
+        s.close()